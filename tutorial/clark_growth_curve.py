@@ -0,0 +1,290 @@
+# Clark's growth curve method (LDF and Cape Cod).
+# Fits a loglogistic or Weibull growth curve G(x | omega, theta) to the incremental losses of every company by
+# maximum likelihood (over-dispersed Poisson), as described in Clark (2003), "LDF Curve-Fitting and Stochastic
+# Reserving: A Maximum Likelihood Approach". The expected incremental loss of accident year i between ages x and y is
+#   LDF method:       ULT_i * (G(y) - G(x))
+#   Cape Cod method:  Premium_i * ELR * (G(y) - G(x))
+# ULT_i (or ELR) has a closed form given omega and theta, so only (log omega, log theta) are optimized, with Newton
+# steps that use the analytic gradient, for all companies at once. The parameter covariance (sigma^2 times the
+# inverse of the information matrix) gives the parameter and process standard deviations of the reserves.
+#
+# Fits that did not converge, that end at a bound of omega or theta, that have no residual degrees of freedom
+# (sigma^2 <= 0) or whose curve is less than MIN_DEVELOPED at the oldest age (the reserves would be almost all
+# extrapolation) are not usable: their curve, reserves and standard deviations are NaN and 'usable' is False, so
+# book totals must be taken over the usable companies (e.g. np.nansum(fit['total_reserve'])).
+#
+# Usage:
+#   fit = fitClarkBook(book, method="capecod", curve="loglogistic")
+#   fit['cdf'], fit['reserves'], fit['total_sd']
+
+import numpy as np
+
+CURVES = ["loglogistic", "weibull"]
+METHODS = ["ldf", "capecod"]
+
+# starting grid for (omega, theta in months)
+_OMEGA_GRID = np.array([0.5, 0.8, 1.2, 1.6, 2.0, 3.0, 4.0])
+_THETA_GRID = np.array([6.0, 12.0, 24.0, 36.0, 60.0, 96.0, 150.0, 240.0])
+# bounds of log omega and log theta
+_BOUNDS = np.log([[0.05, 0.1], [50.0, 1e5]])
+# a parameter this close to a bound (in log units) is at the bound
+_BOUND_TOL = 1e-6
+# smallest share of the ultimate the curve must reach by the oldest age of the triangle
+MIN_DEVELOPED = 0.05
+
+
+def growthCurve(curve, x, a, b):
+    '''This function evaluates the growth curve and its derivatives with respect to a = log(omega) and b = log(theta)
+       x has shape (age,) and a, b have shape (company,). Returns G, dG/da, dG/db of shape (company x age)'''
+    omega = np.exp(a)[:, None]
+    theta = np.exp(b)[:, None]
+    positive = x > 0
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_ratio = np.where(positive, np.log(np.where(positive, x, 1.0)) - np.log(theta), 0.0)
+        if curve == "loglogistic":
+            G = 1 / (1 + np.exp(-omega*log_ratio))
+            slope = G*(1 - G)
+        elif curve == "weibull":
+            v = np.exp(omega*log_ratio)
+            G = -np.expm1(-v)
+            slope = np.exp(-v)*v
+        else:
+            raise ValueError("curve must be one of {}".format(CURVES))
+    G = np.where(positive, G, 0.0)
+    slope = np.where(positive, slope, 0.0)
+    return G, slope*omega*log_ratio, -slope*omega
+
+
+class _Data:
+    '''The incremental losses and exposures of all companies'''
+    def __init__(self, triangle, premium, period_months):
+        observed = np.isfinite(triangle)
+        cumulative = np.where(observed, triangle, 0.0)
+        incremental = np.diff(cumulative, axis=2, prepend=0.0)
+        self.observed = observed
+        self.incremental = np.where(observed, incremental, 0.0)
+        self.latest_lag = np.maximum(observed.sum(axis=2) - 1, 0)          # company x accident year
+        self.rows = observed.any(axis=2)
+        self.paid_to_date = np.take_along_axis(cumulative, self.latest_lag[..., None], axis=2)[..., 0]
+        self.column_sums = self.incremental.sum(axis=1)                    # company x lag
+        self.row_sums = self.incremental.sum(axis=2)                       # company x accident year
+        self.total = self.row_sums.sum(axis=1)
+        n_lags = triangle.shape[2]
+        # ages from the average accident date: the end of lag k is period_months*(k+1) - period_months/2
+        self.ages = period_months*np.arange(1, n_lags + 1) - period_months/2
+        self.grid = np.concatenate([[0.0], self.ages])
+        self.premium = None if premium is None else np.where(self.rows, np.nan_to_num(premium), 0.0)
+
+    def curve(self, curve, a, b):
+        '''This function returns the increments of G over every lag and G at the latest age of every accident year,
+           with their derivatives'''
+        G, Ga, Gb = growthCurve(curve, self.grid, a, b)
+        delta = [np.diff(v, axis=1) for v in (G, Ga, Gb)]
+        latest = [np.take_along_axis(v[:, 1:], self.latest_lag, axis=1) for v in (G, Ga, Gb)]
+        return delta, latest
+
+
+def _profileLoglik(data, method, curve, a, b):
+    '''This function returns the log-likelihood (up to a constant) with ULT_i or ELR at their optimum, and its gradient
+       with respect to (log omega, log theta); shapes (company,) and (company x 2)'''
+    (dG, dGa, dGb), (S, Sa, Sb) = data.curve(curve, a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_dG = np.where(data.column_sums != 0, np.log(dG), 0.0)
+        loglik = (data.column_sums*log_dG).sum(axis=1)
+        grad = np.stack([
+            (np.where(data.column_sums != 0, data.column_sums/dG, 0.0)*d).sum(axis=1) for d in (dGa, dGb)
+        ], axis=1)
+        if method == "ldf":
+            log_S = np.where(data.row_sums != 0, np.log(S), 0.0)
+            loglik -= (data.row_sums*log_S).sum(axis=1)
+            weight = np.where(data.row_sums != 0, data.row_sums/S, 0.0)
+            grad -= np.stack([(weight*Sa).sum(axis=1), (weight*Sb).sum(axis=1)], axis=1)
+        else:
+            D = (data.premium*S).sum(axis=1)
+            loglik -= data.total*np.log(D)
+            grad -= (data.total/D)[:, None]*np.stack([(data.premium*Sa).sum(axis=1), (data.premium*Sb).sum(axis=1)], axis=1)
+    loglik = np.where(np.isfinite(loglik), loglik, -np.inf)
+    return loglik, np.where(np.isfinite(grad), grad, 0.0)
+
+
+def _hessian(data, method, curve, p, h=1e-5):
+    '''This function differentiates the analytic gradient numerically; returns (company x 2 x 2)'''
+    H = np.empty(p.shape + (2,))
+    for k in range(2):
+        step = np.zeros(2)
+        step[k] = h
+        _, g_up = _profileLoglik(data, method, curve, *(p + step).T)
+        _, g_down = _profileLoglik(data, method, curve, *(p - step).T)
+        H[:, :, k] = (g_up - g_down) / (2*h)
+    return (H + H.transpose(0, 2, 1)) / 2
+
+
+def _maximize(data, method, curve, max_iter, tol):
+    '''This function maximizes the profile log-likelihood of every company with damped Newton steps'''
+    n = len(data.total)
+    # start from the best point of a small grid
+    best = np.full(n, -np.inf)
+    p = np.zeros((n, 2))
+    for omega in _OMEGA_GRID:
+        for theta in _THETA_GRID:
+            q = np.tile(np.log([omega, theta]), (n, 1))
+            loglik, _ = _profileLoglik(data, method, curve, *q.T)
+            better = loglik > best
+            best[better] = loglik[better]
+            p[better] = q[better]
+
+    converged = np.zeros(n, dtype=bool)
+    stalled = np.zeros(n, dtype=bool)
+    for _ in range(max_iter):
+        loglik, grad = _profileLoglik(data, method, curve, *p.T)
+        # the log-likelihood scales with the losses, so the gradient is compared with the total loss
+        converged |= np.abs(grad).max(axis=1) < tol*np.maximum(np.abs(data.total), 1.0)
+        active = ~converged & ~stalled & np.isfinite(loglik)
+        if not active.any():
+            break
+        H = _hessian(data, method, curve, p)
+        det = H[:, 0, 0]*H[:, 1, 1] - H[:, 0, 1]**2
+        newton = (H[:, 0, 0] < 0) & (det > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv = np.stack([np.stack([H[:, 1, 1], -H[:, 0, 1]], 1), np.stack([-H[:, 1, 0], H[:, 0, 0]], 1)], 1) / det[:, None, None]
+            direction = np.where(newton[:, None], -np.einsum('cij,cj->ci', inv, grad), grad/np.maximum(np.abs(grad).max(axis=1, keepdims=True), 1.0))
+        direction[~active | ~np.isfinite(direction).all(axis=1)] = 0.0
+        # backtracking line search
+        t = np.ones(n)
+        accepted = ~active
+        for _ in range(40):
+            trial = np.clip(p + t[:, None]*direction, _BOUNDS[0], _BOUNDS[1])
+            trial_loglik, _ = _profileLoglik(data, method, curve, *trial.T)
+            ok = ~accepted & (trial_loglik >= loglik)
+            p[ok] = trial[ok]
+            accepted |= ok
+            if accepted.all():
+                break
+            t = np.where(accepted, t, t/2)
+        # no improvement possible along the direction: stop there
+        stalled |= ~accepted | (active & (np.abs(t[:, None]*direction).max(axis=1) < 1e-12))
+    return p, converged
+
+
+def fitClark(triangle, method="ldf", curve="loglogistic", premium=None, period_months=12, truncation=None,
+             max_iter=100, tol=1e-6):
+    '''This function fits Clark's growth curve to the cumulative loss triangles of all companies
+       triangle has shape (company x accident year x lag) with NaN below the diagonal, premium (company x accident year)
+       is needed for the Cape Cod method, period_months is the length of the accident and development periods and
+       truncation is the age (in months from the average accident date) where development stops (None = no truncation).
+       Returns a dictionary of arrays with the parameters, their covariance, the fitted age-to-ultimate factors and
+       the reserves with their process, parameter and total standard deviations. at_bound marks the fits that end at a
+       parameter bound and usable the converged, interior fits with sigma^2 > 0 and at least MIN_DEVELOPED developed at
+       the oldest age; the other companies get NaN results'''
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+    if method == "capecod" and premium is None:
+        raise ValueError("the Cape Cod method needs the premium of every accident year")
+    data = _Data(np.asarray(triangle, dtype=float), premium, period_months)
+    p, converged = _maximize(data, method, curve, max_iter, tol)
+    a, b = p.T
+    (dG, dGa, dGb), (S, Sa, Sb) = data.curve(curve, a, b)
+    if truncation is None:
+        GT, GTa, GTb = np.ones(len(a)), np.zeros(len(a)), np.zeros(len(a))
+    else:
+        GT, GTa, GTb = [v[:, 0] for v in growthCurve(curve, np.array([float(truncation)]), a, b)]
+
+    n_companies, n_years, n_lags = data.observed.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == "ldf":
+            ULT = data.row_sums / S                                      # company x accident year
+            scale = ULT
+            ELR = None
+        else:
+            ELR = data.total / (data.premium*S).sum(axis=1)
+            scale = data.premium*ELR[:, None]
+        mu = scale[:, :, None]*dG[:, None, :]
+
+        # derivatives of every expected incremental with respect to the parameters
+        if method == "ldf":
+            d_first = np.zeros((n_companies, n_years, n_lags, n_years))
+            d_first[:, np.arange(n_years), :, np.arange(n_years)] = np.broadcast_to(dG[:, None, :], (n_companies, n_years, n_lags)).transpose(1, 0, 2)
+        else:
+            d_first = (data.premium[:, :, None]*dG[:, None, :])[..., None]
+        d_curve = np.stack([scale[:, :, None]*dGa[:, None, :], scale[:, :, None]*dGb[:, None, :]], axis=-1)
+        D = np.concatenate([d_first, d_curve], axis=-1)                 # company x AY x lag x parameter
+        usable = data.observed & (mu > 0)
+        weight = np.where(usable, 1/np.where(usable, mu, 1.0), 0.0)
+        information = np.einsum('cijp,cij,cijq->cpq', D, weight, D)
+        n_parameters = D.shape[-1]
+        n_cells = usable.sum(axis=(1, 2))
+        sigma2 = (weight*(data.incremental - mu)**2).sum(axis=(1, 2)) / (n_cells - n_parameters)
+        covariance = sigma2[:, None, None]*_pinv(information)
+
+        # reserves by accident year and their gradients
+        remaining = GT[:, None] - S
+        reserves = np.where(data.rows, scale*remaining, 0.0)
+        if method == "ldf":
+            dR_first = np.zeros((n_companies, n_years, n_years))
+            dR_first[:, np.arange(n_years), np.arange(n_years)] = remaining
+        else:
+            dR_first = (data.premium*remaining)[..., None]
+        dR_curve = np.stack([scale*(GTa[:, None] - Sa), scale*(GTb[:, None] - Sb)], axis=-1)
+        dR = np.where(data.rows[..., None], np.concatenate([dR_first, dR_curve], axis=-1), 0.0)
+        parameter_var = np.einsum('cip,cpq,ciq->ci', dR, covariance, dR)
+        total_grad = dR.sum(axis=1)
+        total_parameter_var = np.einsum('cp,cpq,cq->c', total_grad, covariance, total_grad)
+        total_reserve = reserves.sum(axis=1)
+
+        # covariance of the natural parameters (..., omega, theta)
+        jacobian = np.ones((n_companies, n_parameters))
+        jacobian[:, -2] = np.exp(a)
+        jacobian[:, -1] = np.exp(b)
+        G_ages = growthCurve(curve, data.ages, a, b)[0]
+        cdf = GT[:, None] / G_ages
+        process_sd = np.sqrt(np.maximum(sigma2[:, None]*reserves, 0))
+        total_sd = np.sqrt(np.maximum(sigma2*total_reserve, 0) + np.maximum(total_parameter_var, 0))
+
+    at_bound = ((np.abs(p - _BOUNDS[0]) < _BOUND_TOL) | (np.abs(p - _BOUNDS[1]) < _BOUND_TOL)).any(axis=1)
+    usable = converged & ~at_bound & (sigma2 > 0) & (G_ages[:, -1] >= MIN_DEVELOPED)
+
+    def fitted(value):
+        # NaN for the companies whose fit is not usable
+        if value is None:
+            return None
+        return np.where(usable.reshape((-1,) + (1,)*(value.ndim - 1)), value, np.nan)
+
+    return {
+        'method': method,
+        'curve': curve,
+        'omega': np.exp(a),
+        'theta': np.exp(b),
+        'ULT': fitted(ULT) if method == "ldf" else None,
+        'ELR': fitted(ELR),
+        'converged': converged,
+        'at_bound': at_bound,
+        'usable': usable,
+        'sigma2': sigma2,
+        'covariance': fitted(covariance * jacobian[:, :, None] * jacobian[:, None, :]),
+        'ages': data.ages,
+        'cdf': fitted(cdf),
+        'reserves': fitted(reserves),
+        'ultimates': fitted(data.paid_to_date + reserves),
+        'process_sd': fitted(process_sd),
+        'parameter_sd': fitted(np.sqrt(np.maximum(parameter_var, 0))),
+        'total_reserve': fitted(total_reserve),
+        'total_sd': fitted(total_sd),
+    }
+
+
+def _pinv(matrices):
+    '''This function inverts a stack of information matrices (pseudo-inverse where they are singular)'''
+    out = np.full(matrices.shape, np.nan)
+    finite = np.isfinite(matrices).all(axis=(1, 2))
+    if finite.any():
+        out[finite] = np.linalg.pinv(matrices[finite], hermitian=True)
+    return out
+
+
+def fitClarkBook(book, method="ldf", curve="loglogistic", column="CumPaidLoss_D", premium=None, truncation=None):
+    '''This function fits Clark's method to every company of a Book
+       The Cape Cod method uses the net earned premium unless an on-level premium (company x accident year) is given.
+       Companies whose fit is not usable have NaN reserves: sum the book with np.nansum or filter on fit['usable']'''
+    if method == "capecod" and premium is None:
+        premium = book.premiums['EarnedPremNet_D']
+    return fitClark(book.triangle(column), method, curve, premium, 12, truncation)
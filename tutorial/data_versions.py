@@ -0,0 +1,144 @@
+# Data version manager.
+# Watches the source files (wkcomp_pos.csv and 605_InflationRates.xlsx) and rebuilds the parsed data, the triangles
+# and the summary results in a background thread when their contents change. A new version is swapped in atomically
+# once it is complete: callers take a snapshot with current() and keep using it for the whole request, so running
+# sessions keep the version they started with and no request ever waits for a rebuild.
+#
+# Usage:
+#   manager = DataVersionManager().start()
+#   snapshot = manager.current()
+#   snapshot.dataset, snapshot.engine, snapshot.indications
+
+import datetime
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    '''One immutable version of the source data and everything derived from it
+       signature is the hash of the source files (see inputHash); callers must not modify the dataframes (take a copy
+       first).'''
+    def __init__(self, version, signature, dataset, inflation_rates, engine, indications):
+        self.version = version
+        self.signature = signature
+        self.dataset = dataset
+        self.inflation_rates = inflation_rates
+        self.engine = engine
+        self.indications = indications
+        self.built_at = datetime.datetime.now()
+
+
+def fileStats(filepaths):
+    '''This function returns the (modification time, size) of every file'''
+    stats = {}
+    for filepath in filepaths:
+        st = os.stat(filepath)
+        stats[filepath] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def buildSnapshot(data_file, inflation_file, version=0, signature=None):
+    '''This function parses the source files and computes the triangles and the indications with the default
+       assumptions for every company
+       signature is the inputHash of the files when the caller has already computed it'''
+    if signature is None:
+        signature = engine_lib.inputHash(data_file, inflation_file)
+    dataset = engine_lib.loadDataset(data_file)
+    inflation_rates = pd.read_excel(inflation_file)
+    engine = engine_lib.PricingEngine(engine_lib.Book.fromDataset(dataset), engine_lib.countryInflation(inflation_rates),
+                                      input_hash=signature)
+    grcodes = engine.book.grcodes
+    results = engine.indicate(grcodes, [engine_lib.normalizeAssumptions()]*len(grcodes))
+    indications = pd.DataFrame({
+        'GRCODE': grcodes,
+        'avg_loss_ratio': results['avg_loss_ratio'],
+        'indicated_avg_rate_change': results['indicated_avg_rate_change'],
+    })
+    return Snapshot(version, signature, dataset, inflation_rates, engine, indications)
+
+
+class DataVersionManager:
+    '''Keeps the current Snapshot and rebuilds it in the background when the source files change
+       Files are polled every interval seconds; a change is only rebuilt once the file stats have been stable for one
+       poll (so half-written files are not parsed) and the contents hash differs from the current version.
+       With use_process, the rebuild runs in a separate process instead of a thread.'''
+    def __init__(self, data_file=engine_lib.DATA_FILE, inflation_file=engine_lib.INFLATION_FILE, interval=2.0,
+                 use_process=False):
+        self.files = (data_file, inflation_file)
+        self.interval = interval
+        self.use_process = use_process
+        self.last_error = None
+        self._snapshot = None
+        self._stats = None
+        self._pending = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''This function builds the first version (blocking, once) and starts the watcher thread'''
+        if self._snapshot is None:
+            self._stats = fileStats(self.files)
+            self._snapshot = buildSnapshot(*self.files, version=1)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="data-version-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def current(self):
+        '''This function returns the current snapshot; it never waits for a rebuild'''
+        if self._snapshot is None:
+            raise RuntimeError("the data version manager has not been started")
+        return self._snapshot
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:       # keep serving the previous version
+                self.last_error = e
+                logger.exception("rebuilding the data failed; keeping version %s", self._snapshot.version)
+
+    def check(self):
+        '''This function polls the files once and rebuilds if their contents changed
+           Returns True if a new version was swapped in'''
+        stats = fileStats(self.files)
+        if stats == self._stats:
+            self._pending = None
+            return False
+        if stats != self._pending:
+            # changed since the last poll: wait until the files are stable
+            self._pending = stats
+            return False
+        self._pending = None
+        current = self._snapshot
+        signature = engine_lib.inputHash(*self.files)
+        if signature == current.signature:
+            self._stats = stats         # touched but not modified
+            return False
+        snapshot = self._build(current.version + 1, signature)
+        # swapping the reference is atomic: readers see either the old or the new snapshot
+        self._snapshot = snapshot
+        self._stats = stats
+        self.last_error = None
+        logger.info("data version %s loaded", snapshot.version)
+        return True
+
+    def _build(self, version, signature=None):
+        if not self.use_process:
+            return buildSnapshot(*self.files, version=version, signature=signature)
+        with ProcessPoolExecutor(1) as pool:
+            return pool.submit(buildSnapshot, *self.files, version=version, signature=signature).result()
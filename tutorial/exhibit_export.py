@@ -0,0 +1,207 @@
+# Rate filing exhibits as Excel workbooks.
+# Writes the loss triangle, LDF triangle, averages of LDFs, selected LDFs/CDFs, on-level and indication exhibits of
+# every company, either one workbook per company (written in parallel) or one sheet per company in a single workbook.
+# Workbooks are written with xlsxwriter in constant_memory mode (rows are streamed to disk as they are completed),
+# the cell formats are created once per workbook and the numbers of all companies come from one vectorized engine call.
+#
+# Usage:
+#   engine = PricingEngine.load()
+#   exportWorkbooks(engine, "exhibits/", workers=4)
+#   exportSingleWorkbook(engine, "exhibits.xlsx")
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xlsxwriter
+
+import ratemaking_engine as engine_lib
+import shared_data
+
+
+def _lagLabels(n):
+    return ["{}".format((i+1)*12) for i in range(n)]
+
+
+def _ldfLabels(n):
+    return ["{}-{}".format((i+1)*12, (i+2)*12) for i in range(n)]
+
+
+def _cdfLabels(n):
+    return ["{}-ult".format(label) for label in _lagLabels(n)]
+
+
+def companyExhibits(engine, grcodes=None, assumptions=None):
+    '''This function collects the exhibits of every company from one vectorized engine call
+       Returns a list of dictionaries of small arrays (cheap to send to worker processes)'''
+    a = engine_lib.normalizeAssumptions(assumptions)
+    if grcodes is None:
+        grcodes = engine.book.grcodes
+    idx = engine.book.index(grcodes)
+    results = engine.indicate(grcodes, [a]*len(idx))
+    averages = engine.averageLDF(a['ldf_latest'])
+    exhibits = []
+    for r, i in enumerate(idx):
+        exhibits.append({
+            'GRCODE': int(engine.book.grcodes[i]),
+            'GRNAME': str(engine.book.names[i]),
+            'years': [int(y) for y in engine.book.years],
+            'ldf_method': a['ldf_method'],
+            'triangle': engine.triangle[i],
+            'ldf': engine.ldf[i],
+            'averages': {method: averages[method][i] for method in engine_lib.LDF_METHODS},
+            'selected_Ldf': results['selected_Ldf'][r],
+            'tail': a['tail'],
+            'cdf': results['cdf'][r],
+            'net_prem_earned': engine.book.premiums['EarnedPremNet_D'][i],
+            'onlevel': results['onlevel'][r],
+            'AdjustedPrem': results['AdjustedPrem'][r],
+            'proj_ultLosses': results['proj_ultLosses'][r],
+            'AdjustedLosses': results['AdjustedLosses'][r],
+            'loss_ratio': results['loss_ratio'][r],
+            'avg_loss_ratio': float(results['avg_loss_ratio'][r]),
+            'permissibleLR': float(results['permissibleLR'][r]),
+            'indicated_avg_rate_change': float(results['indicated_avg_rate_change'][r]),
+        })
+    return exhibits
+
+
+class _Formats:
+    '''The cell formats of a workbook, created once and reused by every sheet'''
+    def __init__(self, workbook):
+        self.title = workbook.add_format({'bold': True, 'font_size': 14})
+        self.section = workbook.add_format({'bold': True, 'font_size': 11, 'bottom': 1})
+        self.header = workbook.add_format({'bold': True, 'bg_color': '#DDEBF7', 'border': 1, 'align': 'center'})
+        self.label = workbook.add_format({'bold': True, 'border': 1})
+        self.amount = workbook.add_format({'num_format': '#,##0', 'border': 1})
+        self.factor = workbook.add_format({'num_format': '0.0000', 'border': 1})
+        self.percent = workbook.add_format({'num_format': '0.00%', 'border': 1})
+        self.result = workbook.add_format({'bold': True, 'num_format': '0.00%', 'border': 2})
+
+
+def _cell(value):
+    '''This function returns None (a blank cell) for missing values'''
+    if value is None:
+        return None
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+class _SheetWriter:
+    '''Writes sections top to bottom, as constant_memory mode requires'''
+    def __init__(self, worksheet, formats):
+        self.ws = worksheet
+        self.f = formats
+        self.row = 0
+
+    def line(self, values, formats):
+        for col, (value, fmt) in enumerate(zip(values, formats)):
+            if isinstance(value, str):
+                self.ws.write_string(self.row, col, value, fmt)
+            elif value is None:
+                self.ws.write_blank(self.row, col, None, fmt)
+            else:
+                self.ws.write_number(self.row, col, value, fmt)
+        self.row += 1
+
+    def skip(self, n=1):
+        self.row += n
+
+    def section(self, title):
+        self.ws.write_string(self.row, 0, title, self.f.section)
+        self.row += 1
+
+    def table(self, title, corner, columns, index, rows, fmt):
+        '''This function writes a titled table; rows is a 2-D sequence aligned with index and columns'''
+        self.section(title)
+        self.line([corner] + list(columns), [self.f.header]*(len(columns) + 1))
+        for label, values in zip(index, rows):
+            self.line([str(label)] + [_cell(v) for v in values], [self.f.label] + [fmt]*len(columns))
+        self.skip()
+
+
+def writeExhibitSheet(worksheet, formats, exhibit):
+    '''This function writes the exhibits of one company on a worksheet'''
+    w = _SheetWriter(worksheet, formats)
+    f = formats
+    years = exhibit['years']
+    n_lags = exhibit['triangle'].shape[1]
+    worksheet.set_column(0, 0, 22)
+    worksheet.set_column(1, n_lags + 1, 13)
+
+    worksheet.write_string(w.row, 0, "{} - {}".format(exhibit['GRCODE'], exhibit['GRNAME']), f.title)
+    w.skip(2)
+    w.table("Loss Development Triangle", "AY", _lagLabels(n_lags), years, exhibit['triangle'], f.amount)
+    w.table("Loss Development Factors", "AY", _ldfLabels(n_lags - 1), years, exhibit['ldf'], f.factor)
+    w.table("Averages of LDFs", "Method", _ldfLabels(n_lags - 1), list(exhibit['averages']),
+            list(exhibit['averages'].values()), f.factor)
+
+    # the selected factors are age-to-age (the last one is the tail), the CDFs age-to-ultimate, as in the script
+    w.table("Selected LDFs", exhibit['ldf_method'], _ldfLabels(n_lags - 1) + ["{}-ult".format(n_lags*12)],
+            ["Selected LDF"], [list(exhibit['selected_Ldf']) + [exhibit['tail']]], f.factor)
+    w.table("Cumulative Development Factors", exhibit['ldf_method'], _cdfLabels(n_lags), ["CDF"], [exhibit['cdf']], f.factor)
+
+    w.section("On-Level Premium")
+    w.line(["AY", "Net Earned Premium", "On-Level Factor", "On-Level Premium"], [f.header]*4)
+    for k, year in enumerate(years):
+        w.line([str(year), _cell(exhibit['net_prem_earned'][k]), _cell(exhibit['onlevel'][k]), _cell(exhibit['AdjustedPrem'][k])],
+               [f.label, f.amount, f.factor, f.amount])
+    w.skip()
+
+    w.section("Indication")
+    w.line(["AY", "Projected Ultimate Losses", "Benefit-Adjusted Losses", "Trended Loss Ratio"], [f.header]*4)
+    for k, year in enumerate(years):
+        w.line([str(year), _cell(exhibit['proj_ultLosses'][k]), _cell(exhibit['AdjustedLosses'][k]), _cell(exhibit['loss_ratio'][k])],
+               [f.label, f.amount, f.amount, f.percent])
+    w.skip()
+    w.line(["Average loss ratio (with ULAE)", _cell(exhibit['avg_loss_ratio'])], [f.label, f.percent])
+    w.line(["Permissible loss ratio", _cell(exhibit['permissibleLR'])], [f.label, f.percent])
+    w.line(["Indicated average rate change", _cell(exhibit['indicated_avg_rate_change'])], [f.label, f.result])
+
+
+def writeCompanyWorkbook(path, exhibit):
+    '''This function writes the filing workbook of one company'''
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        writeExhibitSheet(workbook.add_worksheet("Exhibits"), _Formats(workbook), exhibit)
+    finally:
+        workbook.close()
+    return path
+
+
+def _writeWorkbooks(out_dir, grcodes, assumptions, engine=None):
+    '''This function writes the workbooks of a group of companies
+       In a worker process the engine attached to the shared memory block is used'''
+    exhibits = companyExhibits(engine or shared_data.workerEngine(), grcodes, assumptions)
+    return [writeCompanyWorkbook(os.path.join(out_dir, "{}.xlsx".format(e['GRCODE'])), e) for e in exhibits]
+
+
+def exportWorkbooks(engine, out_dir, grcodes=None, assumptions=None, workers=None, chunk=8):
+    '''This function writes one workbook per company into out_dir, in parallel across companies
+       Workers read the engine from shared memory, so each task only carries chunk GRCODEs.
+       Returns the paths of the workbooks'''
+    os.makedirs(out_dir, exist_ok=True)
+    if grcodes is None:
+        grcodes = engine.book.grcodes
+    grcodes = [int(g) for g in np.atleast_1d(grcodes)]
+    engine.book.index(grcodes)              # unknown GRCODEs fail here, before any work is dispatched
+    if workers == 0:
+        return _writeWorkbooks(out_dir, grcodes, assumptions, engine)
+    groups = [grcodes[i:i + chunk] for i in range(0, len(grcodes), chunk)]
+    with shared_data.shareEngine(engine) as shared:
+        with ProcessPoolExecutor(workers, initializer=shared_data.initWorker, initargs=(shared.manifest,)) as pool:
+            paths = pool.map(_writeWorkbooks, [out_dir]*len(groups), groups, [assumptions]*len(groups))
+            return [path for group in paths for path in group]
+
+
+def exportSingleWorkbook(engine, path, grcodes=None, assumptions=None):
+    '''This function writes one workbook with one sheet per company'''
+    exhibits = companyExhibits(engine, grcodes, assumptions)
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        formats = _Formats(workbook)
+        for exhibit in exhibits:
+            writeExhibitSheet(workbook.add_worksheet(str(exhibit['GRCODE'])), formats, exhibit)
+    finally:
+        workbook.close()
+    return path
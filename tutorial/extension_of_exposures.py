@@ -0,0 +1,119 @@
+# Extension of exposures on-leveling.
+# An alternative to the parallelogram method (earnedPortion / AvgCumulIndices) for policy-level data: every policy is
+# re-rated at the current rate level by applying the rate change history, and its written premium is earned into
+# calendar periods exactly, day by day over its term. It does not need the uniform writing and annual term assumptions.
+#
+# Policies are processed in chunks, so millions of records can be streamed (e.g. from pd.read_csv(chunksize=...))
+# with memory bounded by chunk size x number of periods a term spans (not the number of calendar periods).
+# Expected columns:
+#   effective_date   policy effective date
+#   written_premium  written premium at the rate level in effect on the effective date
+#   term_months      policy term in months (optional, 12 when missing)
+#
+# Usage:
+#   chunks = pd.read_csv("policies.csv", parse_dates=["effective_date"], chunksize=500000)
+#   exhibit = onLevelEarnedPremium(chunks, rate_changes, calendarPeriods(1988, 1997))
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+
+def calendarPeriods(start_year, end_year, periods_per_year=1):
+    '''This function returns the boundaries of the calendar periods (years, quarters or months) from start_year to
+       end_year as datetime64[D]; there is one more boundary than periods'''
+    months = 12 // periods_per_year
+    first = np.datetime64("{:04d}-01".format(start_year), 'M')
+    count = (end_year - start_year + 1) * periods_per_year
+    return (first + np.arange(count + 1) * months).astype('datetime64[D]')
+
+
+def rateLevelIndex(rate_changes):
+    '''This function returns the sorted rate change dates (datetime64[D]) and the cumulative rate level index of every
+       rate level (level 0 is before the first change)'''
+    rate_changes = engine_lib.toChanges(rate_changes, 'rate_changes')
+    dates = np.array([np.datetime64(d, 'D') for d in rate_changes], dtype='datetime64[D]')
+    cum_index = np.cumprod([1.0] + [1 + c for c in rate_changes.values()])
+    return dates, cum_index
+
+
+def expirationDates(effective, term_months):
+    '''This function adds term_months to the effective dates (same day of the month)'''
+    months = effective.astype('datetime64[M]')
+    day = effective - months.astype('datetime64[D]')
+    return (months + term_months).astype('datetime64[D]') + day
+
+
+def earnedPortions(effective, expiration, boundaries):
+    '''This function calculates the portion of every policy's term that falls in the calendar periods it spans
+       Only the periods from the one containing the effective date are kept, so a chunk needs (policy x periods of a
+       term) values instead of (policy x all periods).
+       Returns (period index, portion), both of shape (policy x spanned period); the index is -1 outside the periods'''
+    start = effective.astype(np.int64)
+    end = expiration.astype(np.int64)
+    b = boundaries.astype(np.int64)
+    first = np.searchsorted(b, start, side='right') - 1
+    last = np.searchsorted(b, end, side='left') - 1
+    width = max(int((last - first).max(initial=0)) + 1, 1)
+    idx = first[:, None] + np.arange(width)
+    inside = (idx >= 0) & (idx < len(b) - 1)
+    k = np.clip(idx, 0, len(b) - 2)
+    overlap = np.where(inside, np.clip(np.minimum(end[:, None], b[k + 1]) - np.maximum(start[:, None], b[k]), 0, None), 0)
+    return np.where(inside, idx, -1), overlap / (end - start)[:, None]
+
+
+def onLevelChunk(policies, rate_dates, cum_index, boundaries):
+    '''This function earns the written and the current level premium of one chunk of policies into the calendar periods
+       Returns (earned premium, on-level earned premium), both of shape (period,)'''
+    effective = pd.to_datetime(policies['effective_date']).to_numpy().astype('datetime64[D]')
+    premium = policies['written_premium'].to_numpy(dtype=float)
+    if 'term_months' in policies:
+        term = policies['term_months'].fillna(12).to_numpy(dtype=np.int64)
+    else:
+        term = np.full(len(premium), 12, dtype=np.int64)
+    # rate level in effect on each effective date: changes apply to policies written on or after their date
+    level = np.searchsorted(rate_dates, effective, side='right')
+    onlevel_premium = premium * (cum_index[-1] / cum_index[level])
+    idx, portions = earnedPortions(effective, expirationDates(effective, term), boundaries)
+    inside = idx >= 0
+    n_periods = len(boundaries) - 1
+    earned = np.bincount(idx[inside], weights=(premium[:, None] * portions)[inside], minlength=n_periods)
+    onlevel_earned = np.bincount(idx[inside], weights=(onlevel_premium[:, None] * portions)[inside], minlength=n_periods)
+    return earned, onlevel_earned
+
+
+def onLevelEarnedPremium(policies, rate_changes, boundaries, chunk=500000):
+    '''This function on-levels earned premium by extension of exposures
+       policies is a dataframe or an iterable of dataframes (chunks), rate_changes a dictionary {date: change} and
+       boundaries the calendar period boundaries (see calendarPeriods).
+       Returns a dataframe with the earned premium, the on-level earned premium and the on-level factor of every period'''
+    rate_dates, cum_index = rateLevelIndex(rate_changes)
+    if isinstance(policies, pd.DataFrame):
+        frame = policies
+        policies = (frame.iloc[i:i + chunk] for i in range(0, len(frame), chunk))
+    earned = np.zeros(len(boundaries) - 1)
+    onlevel_earned = np.zeros(len(boundaries) - 1)
+    n_policies = 0
+    for part in policies:
+        e, o = onLevelChunk(part, rate_dates, cum_index, boundaries)
+        earned += e
+        onlevel_earned += o
+        n_policies += len(part)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        onlevel = onlevel_earned / earned
+    return pd.DataFrame({
+        'period_start': boundaries[:-1],
+        'earned_premium': earned,
+        'onlevel_earned_premium': onlevel_earned,
+        'onlevel': onlevel,
+    }).assign(policies=n_policies)
+
+
+def compareWithParallelogram(exhibit, rate_changes):
+    '''This function puts the annual extension of exposures on-level factors next to the parallelogram method ones'''
+    years = pd.DatetimeIndex(exhibit['period_start']).year.to_numpy()
+    changes = engine_lib.toChanges(rate_changes, 'rate_changes')
+    comparison = exhibit[['period_start', 'onlevel']].rename(columns={'onlevel': 'extension_of_exposures'})
+    comparison['parallelogram'] = engine_lib.levelFactors(changes, years)
+    return comparison
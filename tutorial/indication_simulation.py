@@ -0,0 +1,186 @@
+# Monte Carlo indication uncertainty.
+# Samples the inputs of the indication (selected LDFs, tail, inflation trend and the expense, profit and ULAE
+# provisions) from given distributions and evaluates the whole development / on-level / trend / indication chain
+# as broadcast arrays over (company x draw), for every company of the book.
+#
+# Distributions are given per input, around the point assumptions:
+#   {'dist': 'normal', 'sd': 0.01}                    mean defaults to the point assumption
+#   {'dist': 'lognormal', 'cv': 0.1}                  mean defaults to the point assumption
+#   {'dist': 'uniform', 'low': 0.06, 'high': 0.1}
+#   {'dist': 'triangular', 'low': 0.06, 'high': 0.1}  mode defaults to the point assumption
+# 'trend' is a shift (in percentage points) of the average inflation rates, with point value 0.
+# 'ldf' is either {'dist': 'lognormal', 'cv': 0.02} (independent noise on every selected factor) or
+# {'dist': 'residual'}, which resamples the company's standardized residuals of Mack's model (re-centered to mean 0)
+# into the factors of the selected window (the latest ldf_latest years). This is exact for VolumeAvg and SimpleAvg;
+# MedialAvg and GeometricAvg are approximated by the deviation of the simple average of the window.
+#
+# Usage:
+#   engine = PricingEngine.load()
+#   summary = simulateIndications(engine, distributions={'ldf': {'dist': 'residual'}, 'trend': {'dist': 'normal', 'sd': 0.5}})
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+import triangle_diagnostics
+
+# inputs that can be simulated and their point values in the assumptions ('trend' is a shift, point 0)
+SIMULATED_INPUTS = ['ldf', 'tail', 'trend', 'fixed_exp_provision', 'variable_exp_provision', 'profit_provision', 'ulae_ratio']
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def sampleInput(rng, spec, point, size):
+    '''This function draws size samples of one input from its distribution spec'''
+    dist = spec.get('dist', 'normal')
+    if dist == 'fixed':
+        return np.full(size, float(spec.get('value', point)))
+    if dist == 'normal':
+        return rng.normal(spec.get('mean', point), spec['sd'], size)
+    if dist == 'lognormal':
+        mean = spec.get('mean', point)
+        s2 = np.log(1 + spec['cv']**2)
+        return rng.lognormal(np.log(mean) - s2/2, np.sqrt(s2), size)
+    if dist == 'uniform':
+        return rng.uniform(spec['low'], spec['high'], size)
+    if dist == 'triangular':
+        return rng.triangular(spec['low'], spec.get('mode', point), spec['high'], size)
+    raise ValueError("unknown distribution: {!r}".format(dist))
+
+
+def _validate(distributions):
+    unknown = set(distributions) - set(SIMULATED_INPUTS)
+    if unknown:
+        raise ValueError("cannot simulate: {}".format(", ".join(sorted(unknown))))
+    ldf = distributions.get('ldf')
+    if ldf is not None and ldf.get('dist') not in ('lognormal', 'residual'):
+        raise ValueError("ldf distribution must be 'lognormal' or 'residual'")
+
+
+def _residualPools(engine, method='VolumeAvg', n_latest=5):
+    '''This function prepares the residual bootstrap of every company: the company's standardized residuals,
+       re-centered to mean 0 and moved to the front of a (company x cell) pool, and the (company x cell x development
+       period) weights that turn resampled residuals into deviations of the selected averages. Only the cells of the
+       averaging window (the latest n_latest factors, as in computeAverageLDFTensor) get a weight:
+       sigma * sqrt(C) / sum(C) for VolumeAvg, sigma / (sqrt(C) * n) for the other methods (the simple average)'''
+    _, sigma, C, valid = triangle_diagnostics.mackSigma(engine.ldf, engine.triangle)
+    residuals = triangle_diagnostics.standardizedResiduals(engine.ldf, engine.triangle)
+    flat = residuals.reshape(len(residuals), -1)
+    usable = np.isfinite(flat)
+    sizes = usable.sum(axis=1)
+    # the standardized residuals are not mean zero over a company, which would shift every draw
+    centre = np.where(usable, flat, 0.0).sum(axis=1) / np.maximum(sizes, 1)
+    order = np.argsort(~usable, axis=1, kind='stable')
+    pools = np.take_along_axis(np.where(usable, flat - centre[:, None], 0.0), order, axis=1)
+    sigma = np.nan_to_num(sigma)        # no variability where sigma cannot be estimated
+    if method == 'VolumeAvg':
+        later, earlier = engine.triangle[..., 1:], engine.triangle[..., :-1]
+        selected = np.isfinite(later) & np.isfinite(earlier) & (later != 0) & (earlier != 0)
+    else:
+        selected = np.isfinite(engine.ldf) & (engine.ldf != 0)
+    window = engine_lib._latestMask(selected, n_latest) & valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'VolumeAvg':
+            scale = sigma * np.sqrt(C) / np.where(window, C, 0.0).sum(axis=1, keepdims=True)
+        else:
+            scale = sigma / (np.sqrt(C) * window.sum(axis=1, keepdims=True))
+    scale = np.where(window & np.isfinite(scale), scale, 0.0)
+    a, j = np.nonzero(np.isfinite(engine.ldf).any(axis=0))
+    weights = np.zeros((len(scale), len(a), scale.shape[2]))
+    weights[:, np.arange(len(a)), j] = scale[:, a, j]
+    return {'pools': pools, 'sizes': sizes, 'weights': weights}
+
+
+def _sampleLDF(rng, spec, selected_Ldf, draws, residual, companies):
+    '''This function samples the selected LDFs; returns an array of shape (company x draw x development period)'''
+    base = np.broadcast_to(selected_Ldf[:, None, :], (len(companies), draws, selected_Ldf.shape[1]))
+    if spec is None:
+        return base
+    if spec['dist'] == 'lognormal':
+        s2 = np.log(1 + spec['cv']**2)
+        return base * rng.lognormal(-s2/2, np.sqrt(s2), base.shape)
+    # residual bootstrap: deviation of the selected average when the residuals are resampled
+    sizes = np.maximum(residual['sizes'][companies], 1)
+    weights = residual['weights'][companies]             # company x cell x period
+    pools = residual['pools'][companies]
+    shape = (len(companies), draws, weights.shape[1])
+    if len(companies) == 1:
+        # one company per block (many draws): a scalar bound is much faster to sample
+        rstar = pools[0][rng.integers(0, sizes[0], shape, dtype=np.int32)]
+    else:
+        pick = rng.integers(0, sizes[:, None, None], shape, dtype=np.int32)
+        rstar = pools.ravel()[pick + (np.arange(len(companies)) * pools.shape[1])[:, None, None]]
+    return base + rstar @ weights
+
+
+def _blocks(n_companies, n_draws, chunk):
+    '''This function splits the (company x draw) work into blocks of at most chunk pairs'''
+    if n_draws >= chunk:
+        for c in range(n_companies):
+            for start in range(0, n_draws, chunk):
+                yield slice(c, c + 1), slice(start, min(start + chunk, n_draws))
+    else:
+        step = max(chunk // n_draws, 1)
+        for c in range(0, n_companies, step):
+            yield slice(c, min(c + step, n_companies)), slice(0, n_draws)
+
+
+def simulateIndications(engine, grcodes=None, assumptions=None, distributions=None, n_draws=100000,
+                        seed=None, chunk=20000, percentiles=PERCENTILES, keep_draws=False):
+    '''This function simulates the indicated average rate change of every company
+       grcodes defaults to the whole book, assumptions are the point assumptions (see normalizeAssumptions) and
+       distributions maps the inputs in SIMULATED_INPUTS to their distribution specs.
+       Returns a dataframe with the point indication, the mean, standard deviation and percentiles of the simulated
+       indications per company (and the (company x draw) array of draws if keep_draws)'''
+    distributions = dict(distributions or {})
+    _validate(distributions)
+    a = engine_lib.normalizeAssumptions(assumptions)
+    if grcodes is None:
+        grcodes = engine.book.grcodes
+    idx = engine.book.index(grcodes)
+    rng = np.random.default_rng(seed)
+
+    point = engine.indicate(grcodes, [a]*len(idx))
+    selected_Ldf = engine.averageLDF(a['ldf_latest'])[a['ldf_method']][idx]
+    latest = engine.latest[idx]
+    AdjustedPrem = engine.book.premiums['EarnedPremNet_D'][idx] * engine.changeFactors(a['rate_changes'])
+    adjusts = engine.changeFactors(a['benefit_changes'])
+    loss_period, prem_period = engine_lib.trendPeriods(engine.book.years, a['forecast_date'])
+    residual = None
+    if distributions.get('ldf', {}).get('dist') == 'residual':
+        residual = _residualPools(engine, a['ldf_method'], a['ldf_latest'])
+    if residual is not None:
+        residual = {key: value[idx] for key, value in residual.items()}
+
+    def sample(name, shape):
+        value = 0.0 if name == 'trend' else a[name]
+        if name not in distributions:
+            return np.full(shape, value)
+        return sampleInput(rng, distributions[name], value, shape)
+
+    draws = np.empty((len(idx), n_draws))
+    for cs, ds in _blocks(len(idx), n_draws, chunk):
+        companies = np.arange(len(idx))[cs]
+        shape = (len(companies), ds.stop - ds.start)
+        ldf = _sampleLDF(rng, distributions.get('ldf'), selected_Ldf[cs], shape[1], residual, companies)
+        cdf = engine_lib.computeCDFTensor(ldf, sample('tail', shape))
+        proj_ultLosses = engine_lib.projectUltimates(latest[cs][:, None, :], engine.latest_lag, cdf)
+        AdjustedLosses = proj_ultLosses * adjusts
+        rate = 1 + 0.01*(engine.inf_avg + sample('trend', shape)[..., None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            loss_ratio = (AdjustedLosses * rate**loss_period) / (AdjustedPrem[cs][:, None, :] * rate**prem_period)
+            avg_loss_ratio = loss_ratio.mean(axis=2) * (1 + sample('ulae_ratio', shape))
+            permissibleLR = 1 - (sample('variable_exp_provision', shape) + sample('profit_provision', shape))
+            draws[cs, ds] = (avg_loss_ratio + sample('fixed_exp_provision', shape)) / permissibleLR - 1
+
+    summary = pd.DataFrame({
+        'GRCODE': engine.book.grcodes[idx],
+        'indicated_avg_rate_change': point['indicated_avg_rate_change'],
+        'mean': draws.mean(axis=1),
+        'sd': draws.std(axis=1),
+    })
+    for p, values in zip(percentiles, np.percentile(draws, percentiles, axis=1)):
+        summary['p{}'.format(p)] = values
+    if keep_draws:
+        return summary, draws
+    return summary
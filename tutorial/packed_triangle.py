@@ -0,0 +1,167 @@
+# Granularity-aware packed triangles.
+# A development triangle of n origin periods only has n(n+1)/2 filled cells. PackedTriangle stores the cells of many
+# segments as one (segment x cell) array, row by row (origin period 0 lags 0..n-1, origin period 1 lags 0..n-2, ...),
+# with no padding NaNs, optionally as float32. Origin and development periods can be years, quarters or months.
+#
+# The development methods of ratemaking_engine work on (segment x origin x lag) tensors of any size, so they are
+# applied here on bounded chunks of segments: memory scales with the filled cells and the chunk size.
+#
+# Usage:
+#   tri = PackedTriangle.fromDense(quarterly_tensor, "quarterly", dtype=np.float32)
+#   ult = developPacked(tri, ldf_method="VolumeAvg")
+#   annual = tri.toAnnual()
+
+from functools import lru_cache
+
+import numpy as np
+
+import ratemaking_engine as engine_lib
+
+# number of periods in a year for each granularity
+GRANULARITIES = {
+    'annual': 1,
+    'quarterly': 4,
+    'monthly': 12,
+}
+
+
+@lru_cache(maxsize=None)
+def _layout(n):
+    '''This function returns the (origin, lag) position of every packed cell and the offset of every origin row
+       for a triangle of n origin periods'''
+    lengths = np.arange(n, 0, -1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    origins = np.repeat(np.arange(n), lengths)
+    lags = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+    return origins, lags, offsets
+
+
+def cellCount(n):
+    '''This function returns the number of filled cells in a triangle of n origin periods'''
+    return n*(n+1)//2
+
+
+class PackedTriangle:
+    '''Upper-triangular development triangles of many segments, packed row by row
+       values has shape (segment x cell) where cell runs over the n(n+1)/2 filled cells'''
+    def __init__(self, values, n_origins, granularity="annual", start_year=None):
+        if granularity not in GRANULARITIES:
+            raise ValueError("granularity must be one of {}".format(list(GRANULARITIES)))
+        values = np.asarray(values)
+        if values.ndim == 1:
+            values = values[None, :]
+        if values.shape[1] != cellCount(n_origins):
+            raise ValueError("{} cells do not form a triangle of {} origin periods".format(values.shape[1], n_origins))
+        self.values = values
+        self.n_origins = n_origins
+        self.granularity = granularity
+        self.start_year = start_year
+
+    @classmethod
+    def fromDense(cls, dense, granularity="annual", dtype=np.float64, start_year=None):
+        '''This function packs (segment x origin x lag) tensors (cells below the diagonal are dropped)'''
+        dense = np.asarray(dense)
+        if dense.ndim == 2:
+            dense = dense[None]
+        n = dense.shape[1]
+        origins, lags, _ = _layout(n)
+        return cls(dense[:, origins, lags].astype(dtype, copy=False), n, granularity, start_year)
+
+    @classmethod
+    def fromBook(cls, book, column="CumPaidLoss_D", dtype=np.float64):
+        '''This function packs the annual triangles of a Book'''
+        return cls.fromDense(book.triangle(column), "annual", dtype, int(book.years[0]))
+
+    @property
+    def n_segments(self):
+        return self.values.shape[0]
+
+    @property
+    def periods_per_year(self):
+        return GRANULARITIES[self.granularity]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def lagLabels(self):
+        '''This function returns the development ages in months, as in the column labels of the script'''
+        months = 12 // self.periods_per_year
+        return [(j+1)*months for j in range(self.n_origins)]
+
+    def toDense(self, segments=slice(None)):
+        '''This function unpacks some segments into a (segment x origin x lag) tensor with NaN below the diagonal'''
+        values = self.values[segments]
+        if values.ndim == 1:
+            values = values[None, :]
+        origins, lags, _ = _layout(self.n_origins)
+        dense = np.full((values.shape[0], self.n_origins, self.n_origins), np.nan, dtype=np.result_type(values, np.float32))
+        dense[:, origins, lags] = values
+        return dense
+
+    def chunks(self, size=256):
+        '''This function yields (segment slice, dense tensor) pairs of at most size segments'''
+        for start in range(0, self.n_segments, size):
+            part = slice(start, min(start + size, self.n_segments))
+            yield part, self.toDense(part)
+
+    def row(self, origin):
+        '''This function returns the cells of one origin period for every segment (segment x lag)'''
+        _, _, offsets = _layout(self.n_origins)
+        return self.values[:, offsets[origin]:offsets[origin] + self.n_origins - origin]
+
+    def column(self, lag):
+        '''This function returns the cells of one development period for every segment (segment x origin)'''
+        _, _, offsets = _layout(self.n_origins)
+        return self.values[:, offsets[:self.n_origins - lag] + lag]
+
+    def latestDiagonal(self):
+        '''This function returns the latest diagonal (segment x origin)'''
+        _, _, offsets = _layout(self.n_origins)
+        return self.values[:, offsets + np.arange(self.n_origins, 0, -1) - 1]
+
+    def convert(self, granularity):
+        '''This function aggregates the triangles to a coarser granularity (e.g. quarterly to annual)
+           The origin periods inside each coarse origin period are summed, each at the lag that ends with the
+           coarse development period. The number of origin periods has to be a multiple of the ratio of granularities'''
+        if granularity not in GRANULARITIES:
+            raise ValueError("granularity must be one of {}".format(list(GRANULARITIES)))
+        ratio, rest = divmod(self.periods_per_year, GRANULARITIES[granularity])
+        if rest or ratio < 1:
+            raise ValueError("cannot convert {} triangles to {}".format(self.granularity, granularity))
+        if self.n_origins % ratio:
+            raise ValueError("{} origin periods are not a whole number of {} periods".format(self.n_origins, granularity))
+        n = self.n_origins // ratio
+        coarse_origins, coarse_lags, _ = _layout(n)
+        _, _, offsets = _layout(self.n_origins)
+        q = np.arange(ratio)
+        # fine origin period and lag that contribute to every coarse cell
+        origins = coarse_origins[:, None]*ratio + q[None, :]
+        lags = (coarse_lags[:, None] + 1)*ratio - q[None, :] - 1
+        cells = offsets[origins] + lags
+        values = self.values[:, cells].sum(axis=2)
+        return PackedTriangle(values, n, granularity, self.start_year)
+
+    def toAnnual(self):
+        '''This function aggregates the triangles to accident year x development year'''
+        return self.convert("annual")
+
+
+def developPacked(triangle, ldf_method="VolumeAvg", n_latest=5, tail=1.0, chunk=256):
+    '''This function runs the chain ladder on packed triangles of any granularity, chunk by chunk
+       n_latest is the number of latest origin periods in each LDF average.
+       Returns a dictionary with the selected LDFs (segment x lag-1), the CDFs (segment x lag) and the projected
+       ultimate losses (segment x origin)'''
+    n = triangle.n_origins
+    latest_lag = np.arange(n - 1, -1, -1)
+    selected_Ldf = np.empty((triangle.n_segments, n - 1))
+    cdf = np.empty((triangle.n_segments, n))
+    proj_ultLosses = np.empty((triangle.n_segments, n))
+    latest = triangle.latestDiagonal()
+    for part, dense in triangle.chunks(chunk):
+        dense = dense.astype(np.float64, copy=False)
+        ldf = engine_lib.computeLDFTensor(dense)
+        selected_Ldf[part] = engine_lib.computeAverageLDFTensor(ldf, dense, n_latest)[ldf_method]
+        cdf[part] = engine_lib.computeCDFTensor(selected_Ldf[part], np.full(dense.shape[0], tail))
+        proj_ultLosses[part] = engine_lib.projectUltimates(latest[part], latest_lag, cdf[part])
+    return {'selected_Ldf': selected_Ldf, 'cdf': cdf, 'proj_ultLosses': proj_ultLosses}
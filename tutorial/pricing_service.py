@@ -0,0 +1,307 @@
+# Local HTTP pricing service.
+# Keeps a warm PricingEngine (parsed dataset, triangles, averaged LDFs and inflation indices) resident and
+# answers indication requests as JSON. Concurrent requests are coalesced into batches that are evaluated
+# in one vectorized call, optionally in a process pool.
+#
+# Usage:
+#   python pricing_service.py --port 8000 --workers 4
+#
+# Endpoints:
+#   POST /indication    {"GRCODE": 86, "assumptions": {"ldf_method": "VolumeAvg", "tail": 1.01}}
+#                       or a JSON list of such objects
+#   GET  /health
+#   GET  /metrics
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ratemaking_engine as engine_lib
+import shared_data
+
+# keys of the engine results that are returned per accident year
+_BY_YEAR = ['proj_ultLosses', 'onlevel', 'AdjustedPrem', 'AdjustedLosses', 'loss_ratio']
+
+
+def _ping():
+    return shared_data.workerEngine() is not None
+
+
+def _rejectConstant(name):
+    '''json.loads hook: NaN, Infinity and -Infinity are not valid inputs'''
+    raise ValueError("invalid number: {}".format(name))
+
+
+def _toJSON(value):
+    '''This function converts numpy values to JSON types (NaN and inf become null)'''
+    if isinstance(value, np.ndarray):
+        return [_toJSON(v) for v in value.tolist()]
+    if isinstance(value, list):
+        return [_toJSON(v) for v in value]
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        return value if math.isfinite(value) else None
+    return value
+
+
+def indicateBatch(grcodes, assumptions, engine=None):
+    '''This function evaluates a batch of requests in one vectorized call and returns one JSON-ready dict per request
+       In a worker process the engine attached to the shared memory block is used'''
+    engine = engine or shared_data.workerEngine()
+    results = engine.indicate(grcodes, assumptions)
+    years = [int(y) for y in engine.book.years]
+    out = []
+    for r in range(len(grcodes)):
+        item = {
+            'GRCODE': int(results['GRCODE'][r]),
+            'indicated_avg_rate_change': _toJSON(results['indicated_avg_rate_change'][r]),
+            'avg_loss_ratio': _toJSON(results['avg_loss_ratio'][r]),
+            'permissibleLR': _toJSON(results['permissibleLR'][r]),
+            'selected_Ldf': _toJSON(results['selected_Ldf'][r]),
+            'cdf': _toJSON(results['cdf'][r]),
+            'AccidentYear': years,
+        }
+        for key in _BY_YEAR:
+            item[key] = _toJSON(results[key][r])
+        out.append(item)
+    return out
+
+
+class Metrics:
+    '''Counters and a window of recent latencies for the /metrics endpoint'''
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_items = 0
+        self.latencies = collections.deque(maxlen=window)     # seconds
+
+    def snapshot(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = {}
+        if len(latencies):
+            for p in [50, 90, 99]:
+                percentiles['p{}_ms'.format(p)] = round(float(np.percentile(latencies, p)), 3)
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'avg_batch_size': round(self.batched_items / self.batches, 2) if self.batches else 0,
+            'latency': percentiles,
+        }
+
+
+class PricingService:
+    '''An asyncio HTTP server around a warm PricingEngine
+       Items waiting in the queue are flushed as one batch when max_batch items are queued or
+       max_wait seconds have passed since the first one arrived.'''
+    def __init__(self, engine, workers=0, max_batch=256, max_wait=0.002):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = Metrics()
+        self.pool = None
+        self.shared = None
+        if workers:
+            # workers attach to the engine's arrays in shared memory instead of loading the source files
+            self.shared = shared_data.shareEngine(engine)
+            self.pool = ProcessPoolExecutor(workers, initializer=shared_data.initWorker, initargs=(self.shared.manifest,))
+        self._queue = None
+        self._server = None
+        self._batcher = None
+        self._running = set()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batchLoop())
+        if self.pool is not None:
+            # load the engine in every worker before the first request arrives
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[loop.run_in_executor(self.pool, _ping) for _ in range(self.pool._max_workers)])
+        self._server = await asyncio.start_server(self._handleConnection, host, port, backlog=1024)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.shared is not None:
+            self.shared.unlink()
+
+    async def indicate(self, grcode, assumptions):
+        '''This function queues one request and waits for its batch to be evaluated'''
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((grcode, assumptions, future))
+        return await future
+
+    async def _batchLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # dispatch without waiting, so the next batch can be collected meanwhile
+            task = asyncio.create_task(self._runBatch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _runBatch(self, batch):
+        grcodes = [item[0] for item in batch]
+        assumptions = [item[1] for item in batch]
+        self.metrics.batches += 1
+        self.metrics.batched_items += len(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            if self.pool is not None:
+                results = await loop.run_in_executor(self.pool, indicateBatch, grcodes, assumptions)
+            else:
+                results = await loop.run_in_executor(None, indicateBatch, grcodes, assumptions, self.engine)
+        except Exception as e:
+            for item in batch:
+                if not item[2].done():
+                    item[2].set_exception(e)
+            return
+        for item, result in zip(batch, results):
+            if not item[2].done():
+                item[2].set_result(result)
+
+    def _parseItem(self, item):
+        '''This function validates one request object; raises ValueError for bad requests'''
+        if not isinstance(item, dict) or 'GRCODE' not in item:
+            raise ValueError("each request needs a GRCODE")
+        try:
+            grcode = int(item['GRCODE'])
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError("GRCODE must be an integer")
+        try:
+            self.engine.book.index([grcode])
+        except KeyError as e:
+            raise ValueError(e.args[0])
+        assumptions = item.get('assumptions')
+        if assumptions is not None and not isinstance(assumptions, dict):
+            raise ValueError("assumptions must be an object")
+        return grcode, engine_lib.normalizeAssumptions(assumptions)
+
+    async def _route(self, method, path, body):
+        '''This function returns (status, payload) for a request'''
+        if path == "/health" and method == "GET":
+            return 200, {'status': 'ok', 'companies': len(self.engine.book.grcodes),
+                         'workers': self.pool._max_workers if self.pool else 0}
+        if path == "/metrics" and method == "GET":
+            return 200, self.metrics.snapshot()
+        if path == "/indication":
+            if method != "POST":
+                return 405, {'error': "use POST"}
+            try:
+                payload = json.loads(body or b"null", parse_constant=_rejectConstant)
+                items = payload if isinstance(payload, list) else [payload]
+                parsed = [self._parseItem(item) for item in items]
+            except ValueError as e:     # includes json.JSONDecodeError
+                return 400, {'error': str(e)}
+            results = await asyncio.gather(*[self.indicate(g, a) for g, a in parsed])
+            return 200, results if isinstance(payload, list) else results[0]
+        return 404, {'error': "not found"}
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload).encode()
+        writer.write(
+            "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                status, _REASONS.get(status, ""), len(data), "keep-alive" if keep_alive else "close"
+            ).encode() + data
+        )
+        await writer.drain()
+
+    async def _handleConnection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode('latin-1').partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                    if length < 0:
+                        raise ValueError
+                except ValueError:
+                    # the body cannot be delimited: answer and drop the connection
+                    self.metrics.requests += 1
+                    self.metrics.errors += 1
+                    await self._respond(writer, 400, {'error': "invalid Content-Length"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                start = time.perf_counter()
+                self.metrics.requests += 1
+                try:
+                    status, payload = await self._route(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                if status >= 400:
+                    self.metrics.errors += 1
+                self.metrics.latencies.append(time.perf_counter() - start)
+
+                keep_alive = (version == "HTTP/1.1" and headers.get('connection', '').lower() != "close") \
+                    or headers.get('connection', '').lower() == "keep-alive"
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+async def serve(host, port, workers, max_batch, max_wait):
+    service = PricingService(engine_lib.PricingEngine.load(), workers=workers, max_batch=max_batch, max_wait=max_wait)
+    server = await service.start(host, port)
+    print("Pricing service listening on http://{}:{}".format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP pricing service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=0, help="size of the process pool (0 = compute in a thread)")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.workers, args.max_batch, args.max_wait_ms / 1000))
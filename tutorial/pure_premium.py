@@ -0,0 +1,206 @@
+# Pure premium method.
+# Workers' compensation is rated per $100 of payroll, so next to the loss ratio method (loss_ratio / permissibleLR)
+# the indication can be made with the pure premium method: the developed and benefit-adjusted losses
+# (AdjustedLosses of the engine) are trended with separate frequency and severity trends net of wage growth, the
+# trended pure premiums of the accident years are averaged with their payroll as weights, and the indicated rate per
+# $100 of payroll is
+#   (pure premium + fixed expense per exposure) / (1 - variable expense provision - profit provision)
+#
+# The frequency trend is per worker (claim counts of a constant workforce), not per $100 of payroll: payroll per
+# worker grows with wages, so the pure premium per $100 of payroll trends by
+#   (1 + frequency_trend) * (1 + severity_trend) / (1 + wage_inflation)
+# and wage growth that is passed through to the (wage-linked) severity leaves it unchanged. A frequency trend measured
+# per $100 of payroll must be converted first: (1 + trend per $100 of payroll) * (1 + wage_inflation) - 1.
+#
+# Schedule P has no payroll, so the exposures are given as a dataframe with one row per cell and accident year:
+#   GRCODE        company of the cell
+#   AccidentYear  accident year
+#   Payroll       payroll of the cell in the accident year
+#   LossShare     share of the company's losses of the accident year (optional, payroll share when missing)
+#   PremiumShare  share of the company's on-level premium of the accident year (optional, payroll share when missing)
+# Any other columns (e.g. State, ClassCode) identify the cells within a company.
+#
+# Usage:
+#   engine = PricingEngine.load()
+#   cells = purePremiumIndication(engine, exposures, pure_premium_assumptions={'wage_inflation': 0.035})
+#   comparison = compareMethods(engine, exposures)
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# assumptions of the pure premium method (the expense and profit provisions come from the engine's assumptions)
+PURE_PREMIUM_ASSUMPTIONS = {
+    'wage_inflation': 0.03,             # annual growth of payroll per worker
+    'frequency_trend': -0.02,           # annual change of claims per worker (not per $100 of payroll)
+    'severity_trend': 0.05,             # annual change of the average claim
+    'fixed_exp_per_exposure': None,     # per $100 of payroll; None derives it from fixed_exp_provision
+}
+
+EXPOSURE_COLUMNS = ['GRCODE', 'AccidentYear', 'Payroll', 'LossShare', 'PremiumShare']
+
+
+def normalizePurePremiumAssumptions(assumptions=None):
+    '''This function merges the given assumptions with PURE_PREMIUM_ASSUMPTIONS and validates them'''
+    assumptions = dict(assumptions or {})
+    unknown = set(assumptions) - set(PURE_PREMIUM_ASSUMPTIONS)
+    if unknown:
+        raise ValueError("unknown assumptions: {}".format(", ".join(sorted(unknown))))
+    result = dict(PURE_PREMIUM_ASSUMPTIONS)
+    result.update(assumptions)
+    try:
+        for key in ['wage_inflation', 'frequency_trend', 'severity_trend']:
+            result[key] = float(result[key])
+        if result['fixed_exp_per_exposure'] is not None:
+            result['fixed_exp_per_exposure'] = float(result['fixed_exp_per_exposure'])
+    except (TypeError, ValueError):
+        raise ValueError("numeric assumption expected")
+    return result
+
+
+def impliedPayroll(engine, rate_per_100):
+    '''This function builds an exposures dataframe (one cell per company) with the payroll implied by the net earned
+       premium and a manual rate per $100 of payroll, for trying the method on data without payroll'''
+    book = engine.book
+    premium = book.premiums['EarnedPremNet_D']
+    c, a = np.nonzero(np.isfinite(premium) & (premium > 0))
+    return pd.DataFrame({
+        'GRCODE': book.grcodes[c],
+        'AccidentYear': book.years[a],
+        'Payroll': premium[c, a] / rate_per_100 * 100,
+    })
+
+
+def exposureCells(book, exposures):
+    '''This function pivots the exposures dataframe into (cell x accident year) arrays
+       Returns (cells dataframe, company position of every cell, payroll, loss share, premium share)'''
+    missing = {'GRCODE', 'AccidentYear', 'Payroll'} - set(exposures.columns)
+    if missing:
+        raise ValueError("exposures need the columns: {}".format(", ".join(sorted(missing))))
+    keys = ['GRCODE'] + [c for c in exposures.columns if c not in EXPOSURE_COLUMNS]
+    cell_idx = exposures.groupby(keys, sort=True, dropna=False).ngroup().to_numpy()
+    n_cells = cell_idx.max() + 1 if len(cell_idx) else 0
+    year_pos = {int(y): k for k, y in enumerate(book.years)}
+    try:
+        a_idx = np.array([year_pos[int(y)] for y in exposures['AccidentYear']], dtype=np.intp)
+    except KeyError as e:
+        raise KeyError("accident year not in the book: {}".format(e.args[0]))
+
+    first = np.unique(cell_idx, return_index=True)[1]
+    table = exposures[keys].iloc[first].reset_index(drop=True)
+    company = book.index(table['GRCODE'])
+    shape = (n_cells, len(book.years))
+    payroll = np.zeros(shape)
+    np.add.at(payroll, (cell_idx, a_idx), exposures['Payroll'].to_numpy(dtype=float))
+
+    # payroll share of every cell within its company and accident year
+    company_payroll = np.zeros((len(book.grcodes), shape[1]))
+    np.add.at(company_payroll, company, payroll)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        payroll_share = np.nan_to_num(payroll / company_payroll[company])
+    shares = []
+    for column in ['LossShare', 'PremiumShare']:
+        if column not in exposures:
+            shares.append(payroll_share)
+            continue
+        share = np.zeros(shape)
+        given = exposures[column].notna().to_numpy()
+        share[cell_idx[given], a_idx[given]] = exposures[column].to_numpy(dtype=float)[given]
+        filled = np.zeros(shape, dtype=bool)
+        filled[cell_idx[given], a_idx[given]] = True
+        shares.append(np.where(filled, share, payroll_share))
+    return table, company, payroll, shares[0], shares[1]
+
+
+def _purePremiumRates(losses, payroll, premium, trend, a, pp):
+    '''This function applies the pure premium method to (cell x accident year) arrays
+       trend is the pure premium trend factor of every accident year; the trended pure premiums of the years are
+       averaged with their payroll as weights.
+       Returns a dictionary of arrays with one value per cell'''
+    units = payroll / 100                      # exposure base: $100 of payroll
+    used = (units > 0) & np.isfinite(losses) & np.isfinite(premium)
+    units = np.where(used, units, 0.0)
+    trended_losses = np.where(used, losses * trend, 0.0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pure_premium = trended_losses / units.sum(axis=1) * (1 + a['ulae_ratio'])
+        # the rate per $100 of payroll does not move with wages, so the current rate needs no trend
+        onlevel_premium = np.where(used, premium, 0.0).sum(axis=1)
+        current_rate = onlevel_premium / units.sum(axis=1)
+    fixed = pp['fixed_exp_per_exposure']
+    if fixed is None:
+        fixed = a['fixed_exp_provision'] * current_rate
+    permissibleLR = 1 - (a['variable_exp_provision'] + a['profit_provision'])
+    indicated_rate = (pure_premium + fixed) / permissibleLR
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = indicated_rate / current_rate - 1
+    return {
+        'payroll': payroll.sum(axis=1),
+        'onlevel_premium': onlevel_premium,
+        'pure_premium': pure_premium,
+        'fixed_exp_per_exposure': np.broadcast_to(fixed, pure_premium.shape),
+        'current_rate': current_rate,
+        'indicated_rate': indicated_rate,
+        'pure_premium_rate_change': change,
+    }
+
+
+def _prepare(engine, exposures, grcodes, assumptions, pure_premium_assumptions):
+    '''This function runs the engine once and allocates its losses and premiums to the cells'''
+    a = engine_lib.normalizeAssumptions(assumptions)
+    pp = normalizePurePremiumAssumptions(pure_premium_assumptions)
+    if grcodes is not None:
+        exposures = exposures[exposures['GRCODE'].isin(np.atleast_1d(grcodes))]
+    table, company, payroll, loss_share, prem_share = exposureCells(engine.book, exposures)
+    companies, row = np.unique(company, return_inverse=True)
+    results = engine.indicate(engine.book.grcodes[companies], [a]*len(companies))
+
+    loss_period, _ = engine_lib.trendPeriods(engine.book.years, a['forecast_date'])
+    # losses of a constant workforce move with claims per worker and severity, its payroll with wages: the wage
+    # growth is counted once, in the denominator
+    trend = ((1 + pp['frequency_trend']) * (1 + pp['severity_trend']) / (1 + pp['wage_inflation']))**loss_period
+    losses = results['AdjustedLosses'][row] * loss_share
+    premium = results['AdjustedPrem'][row] * prem_share
+    return a, pp, table, row, results, payroll, losses, premium, trend
+
+
+def purePremiumIndication(engine, exposures, grcodes=None, assumptions=None, pure_premium_assumptions=None):
+    '''This function computes the pure premium indication of every cell (company, state, class, ...) of the exposures
+       next to its company's loss ratio method indication, from one vectorized engine call
+       assumptions are the engine's assumptions (see normalizeAssumptions) and pure_premium_assumptions the trends and
+       fixed expense of the pure premium method (see PURE_PREMIUM_ASSUMPTIONS).
+       Returns a dataframe with one row per cell'''
+    a, pp, table, row, results, payroll, losses, premium, trend = \
+        _prepare(engine, exposures, grcodes, assumptions, pure_premium_assumptions)
+    rates = _purePremiumRates(losses, payroll, premium, trend, a, pp)
+    exhibit = table.copy()
+    for key, value in rates.items():
+        exhibit[key] = value
+    exhibit['loss_ratio_rate_change'] = results['indicated_avg_rate_change'][row]
+    return exhibit
+
+
+def compareMethods(engine, exposures, grcodes=None, assumptions=None, pure_premium_assumptions=None):
+    '''This function puts the loss ratio and the pure premium indications of every company side by side
+       (the cells of each company are combined before the pure premium method is applied)'''
+    a, pp, table, row, results, payroll, losses, premium, trend = \
+        _prepare(engine, exposures, grcodes, assumptions, pure_premium_assumptions)
+
+    def combine(values):
+        total = np.zeros((len(results['GRCODE']), values.shape[1]))
+        np.add.at(total, row, np.nan_to_num(values))
+        return total
+
+    # a company-year without any usable cell stays excluded
+    missing = combine(np.isfinite(losses) & np.isfinite(premium)) == 0
+    losses_total = np.where(missing, np.nan, combine(losses))
+    rates = _purePremiumRates(losses_total, combine(payroll), combine(premium), trend, a, pp)
+    return pd.DataFrame({
+        'GRCODE': results['GRCODE'],
+        'avg_loss_ratio': results['avg_loss_ratio'],
+        'loss_ratio_rate_change': results['indicated_avg_rate_change'],
+        'pure_premium': rates['pure_premium'],
+        'current_rate': rates['current_rate'],
+        'indicated_rate': rates['indicated_rate'],
+        'pure_premium_rate_change': rates['pure_premium_rate_change'],
+    })
@@ -0,0 +1,147 @@
+# Analytical query layer.
+# Exposes the Schedule P dataset and the engine's triangles, LDFs and indications as SQL tables of an in-process
+# DuckDB database, for ad hoc book-wide questions without editing the script's dataset[dataset["GRCODE"]==grcode]
+# filters. The dataframes are registered, not copied: DuckDB scans their columns in place, reads only the columns a
+# query uses and runs on several threads. Queries return a lazy relation (sql) or a dataframe of the result (query).
+#
+# Tables:
+#   schedule_p        the source dataset (one row per GRCODE, AccidentYear, DevelopmentLag)
+#   ldfs              age-to-age factors: GRCODE, AccidentYear, age_from, age_to, ldf
+#   average_ldfs      averages of the LDFs: GRCODE, method, age_from, age_to, factor
+#   indications       one row per company: GRCODE, GRNAME, premium, avg_loss_ratio, indicated_avg_rate_change, ...
+#   indication_years  one row per company and accident year: cdf, proj_ultLosses, onlevel, AdjustedPrem, ...
+#
+# Usage:
+#   db = QueryLayer(PricingEngine.load(), loadDataset())
+#   db.query("""SELECT size_decile, avg(factor) AS ldf_12_24
+#               FROM average_ldfs JOIN (SELECT GRCODE, ntile(10) OVER (ORDER BY premium) AS size_decile
+#                                       FROM indications) USING (GRCODE)
+#               WHERE method = 'VolumeAvg' AND age_from = 12 GROUP BY ALL ORDER BY 1""")
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# per accident year results of the engine exposed in indication_years
+_BY_YEAR = ['proj_ultLosses', 'onlevel', 'AdjustedPrem', 'AdjustedLosses', 'loss_ratio']
+
+
+def ldfTable(engine):
+    '''This function flattens the (company x accident year x development period) LDF tensor into a long dataframe'''
+    ldf = engine.ldf
+    c, a, j = np.nonzero(np.isfinite(ldf))
+    return pd.DataFrame({
+        'GRCODE': engine.book.grcodes[c],
+        'AccidentYear': engine.book.years[a],
+        'age_from': (j + 1) * 12,
+        'age_to': (j + 2) * 12,
+        'ldf': ldf[c, a, j],
+    })
+
+
+def averageLDFTable(engine, n_latest=5):
+    '''This function flattens the averages of the LDFs of every method into a long dataframe'''
+    averages = engine.averageLDF(n_latest)
+    frames = []
+    for method in engine_lib.LDF_METHODS:
+        c, j = np.nonzero(np.isfinite(averages[method]))
+        frames.append(pd.DataFrame({
+            'GRCODE': engine.book.grcodes[c],
+            'method': method,
+            'age_from': (j + 1) * 12,
+            'age_to': (j + 2) * 12,
+            'factor': averages[method][c, j],
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def indicationTables(engine, assumptions=None):
+    '''This function computes the indications of every company and returns the (company, company x accident year)
+       dataframes'''
+    a = engine_lib.normalizeAssumptions(assumptions)
+    book = engine.book
+    results = engine.indicate(book.grcodes, [a]*len(book.grcodes))
+    companies = pd.DataFrame({
+        'GRCODE': book.grcodes,
+        'GRNAME': book.names.astype(str),
+        'premium': np.nansum(book.premiums['EarnedPremNet_D'], axis=1),
+        'posted_reserves': book.posted_reserves,
+        'avg_loss_ratio': results['avg_loss_ratio'],
+        'permissibleLR': results['permissibleLR'],
+        'indicated_avg_rate_change': results['indicated_avg_rate_change'],
+    })
+    n_companies, n_years = results['AdjustedPrem'].shape
+    years = pd.DataFrame({
+        'GRCODE': np.repeat(book.grcodes, n_years),
+        'AccidentYear': np.tile(book.years, n_companies),
+        # the CDF to ultimate of each accident year's latest age
+        'cdf': results['cdf'][:, engine.latest_lag].ravel(),
+    })
+    for key in _BY_YEAR:
+        years[key] = results[key].ravel()
+    return companies, years
+
+
+class QueryLayer:
+    '''An in-process DuckDB database over the dataset and the engine results
+       threads defaults to DuckDB's choice (all cores). Use cursor() for queries from other threads.'''
+    def __init__(self, engine, dataset=None, assumptions=None, n_latest=5, threads=None):
+        self.engine = engine
+        self.con = duckdb.connect(":memory:")
+        if threads is not None:
+            self.con.execute("SET threads = {:d}".format(int(threads)))
+        self._tables = {}
+        if dataset is not None:
+            self.register("schedule_p", dataset)
+        self.register("ldfs", ldfTable(engine))
+        self.register("average_ldfs", averageLDFTable(engine, n_latest))
+        self.refresh(assumptions)
+
+    @classmethod
+    def fromSnapshot(cls, snapshot, **kwargs):
+        '''This function builds a query layer over a data version (see data_versions.py)'''
+        return cls(snapshot.engine, snapshot.dataset, **kwargs)
+
+    def register(self, name, frame):
+        '''This function exposes a dataframe as a table (the dataframe is scanned in place, not copied)'''
+        self._tables[name] = frame           # DuckDB does not keep the dataframe alive
+        self.con.register(name, frame)
+
+    def refresh(self, assumptions=None):
+        '''This function recomputes the indication tables with another set of assumptions'''
+        companies, years = indicationTables(self.engine, assumptions)
+        self.register("indications", companies)
+        self.register("indication_years", years)
+
+    @property
+    def tables(self):
+        return sorted(self._tables)
+
+    def sql(self, query, params=None):
+        '''This function returns a lazy DuckDB relation (nothing is computed until it is fetched)'''
+        if params is None:
+            return self.con.sql(query)
+        return self.con.sql(query, params=params)
+
+    def query(self, query, params=None):
+        '''This function runs a query and returns the result as a dataframe'''
+        return self.con.execute(query, params or []).df()
+
+    def cursor(self):
+        '''This function returns a connection for another thread, with the same tables'''
+        cursor = self.con.cursor()
+        # registered dataframes are local to a connection
+        for name, frame in self._tables.items():
+            cursor.register(name, frame)
+        return cursor
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,163 @@
+# Rate capping and off-balance.
+# The indicated changes of individual cells (e.g. state/class of every company) are capped, for example at +/-15%,
+# and the off-balance - the premium lost (or gained) by capping - is redistributed to the cells that are not capped,
+# so that the premium-weighted overall change of every group still meets its target. Redistributing can push more
+# cells to a cap, so the balancing change is found by a fixed-point iteration, run for all groups at once over flat
+# cell arrays (safeguarded Newton steps on the piecewise linear balance of each group, so it ends in a few steps).
+#
+# The off-balance is applied multiplicatively (the uncapped rate factors are scaled by a common factor) or additively
+# (a common number of points is added to the uncapped changes).
+#
+# Usage:
+#   cells = purePremiumIndication(engine, exposures)
+#   capped, groups = capCells(cells, 'pure_premium_rate_change', 'onlevel_premium', floor=-0.15, cap=0.15)
+#   exhibit = impactExhibit(capped, groups)
+
+import numpy as np
+import pandas as pd
+
+BALANCE_METHODS = ['multiplicative', 'additive']
+
+
+def _groupSum(values, groups, n_groups):
+    return np.bincount(groups, weights=values, minlength=n_groups)
+
+
+def capChanges(changes, weights, groups=None, target=None, floor=-0.15, cap=0.15, balance='multiplicative',
+               max_iter=100, tol=1e-10):
+    '''This function caps the changes of the cells and balances every group back to its target
+       changes and weights (premium) are flat arrays over the cells, groups the group position of every cell (one group
+       when missing), target the overall change of every group (the premium-weighted indicated change when missing),
+       floor and cap scalars or arrays over the cells.
+       Returns a dictionary with the capped changes of the cells and, per group, the target, the achieved change,
+       the off-balance adjustment, the number of iterations, whether the target can be met within the caps (feasible)
+       and whether it was met (converged)'''
+    if balance not in BALANCE_METHODS:
+        raise ValueError("balance must be one of {}".format(BALANCE_METHODS))
+    changes = np.asarray(changes, dtype=float)
+    weights = np.nan_to_num(np.asarray(weights, dtype=float))
+    groups = np.zeros(len(changes), dtype=np.intp) if groups is None else np.asarray(groups, dtype=np.intp)
+    n_groups = groups.max() + 1 if len(groups) else 0
+    floor = np.broadcast_to(np.asarray(floor, dtype=float), changes.shape)
+    cap = np.broadcast_to(np.asarray(cap, dtype=float), changes.shape)
+    if np.any(floor > cap):
+        raise ValueError("floor must not be above cap")
+    usable = np.isfinite(changes) & (weights > 0)
+    changes = np.where(usable, changes, 0.0)
+    weights = np.where(usable, weights, 0.0)
+
+    total = _groupSum(weights, groups, n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if target is None:
+            target = _groupSum(weights * changes, groups, n_groups) / total
+        target = np.broadcast_to(np.asarray(target, dtype=float), (n_groups,)).copy()
+    # d moves the uncapped changes: change + d (additive) or (1 + change) * (1 + d) - 1 (multiplicative)
+    slope = np.ones_like(changes) if balance == 'additive' else 1 + changes
+    d = np.zeros(n_groups)
+    # the balance decreases with d: lo and hi bracket the solution, Newton steps falling outside are bisected
+    lo = np.full(n_groups, -np.inf if balance == 'additive' else -1.0)
+    hi = np.full(n_groups, np.inf)
+    # the target must lie between the premium-weighted floors and caps of the group
+    with np.errstate(invalid='ignore'):
+        feasible = (target * total >= _groupSum(weights * floor, groups, n_groups) - tol * total) & \
+                   (target * total <= _groupSum(weights * cap, groups, n_groups) + tol * total)
+    converged = np.zeros(n_groups, dtype=bool)
+    iterations = np.zeros(n_groups, dtype=np.int64)
+    for _ in range(max_iter):
+        moved = changes + d[groups] * slope
+        off_balance = target * total - _groupSum(weights * np.clip(moved, floor, cap), groups, n_groups)
+        converged |= np.abs(off_balance) <= tol * total
+        up = off_balance > 0
+        lo = np.where(up, np.maximum(lo, d), lo)
+        hi = np.where(up, hi, np.minimum(hi, d))
+        # slope of the balance in the direction of the step: the cells that can still move that way
+        can_move = np.where(up[groups], moved < cap, moved > floor)
+        free_slope = _groupSum(weights * slope * can_move, groups, n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = d + off_balance / free_slope
+            bisect = (lo + hi) / 2
+        step = np.where((newton > lo) & (newton < hi), newton, bisect)
+        active = feasible & ~converged & np.isfinite(step)
+        if not active.any():
+            break
+        iterations += active
+        d = np.where(active, step, d)
+
+    moved = changes + d[groups] * slope
+    capped = np.clip(moved, floor, cap)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        achieved = _groupSum(weights * capped, groups, n_groups) / total
+    capped = np.where(usable, capped, np.nan)
+    return {
+        'capped': capped,
+        'at_floor': usable & (moved <= floor),
+        'at_cap': usable & (moved >= cap),
+        'target': target,
+        'achieved': achieved,
+        'off_balance': d,
+        'iterations': iterations,
+        'feasible': feasible,
+        'converged': converged,
+    }
+
+
+def capCells(cells, change_column, premium_column, group_column='GRCODE', target=None, floor=-0.15, cap=0.15,
+             balance='multiplicative', max_iter=100, tol=1e-10):
+    '''This function caps the changes of a dataframe of cells within each group (company by default)
+       target is None (premium-weighted indicated change of the group), a column name holding the group's target
+       (e.g. loss_ratio_rate_change) or a mapping group -> target; floor and cap are values or column names.
+       Returns (a copy of cells with the capped changes, a dataframe of the group results)'''
+    keys, groups = np.unique(cells[group_column].to_numpy(), return_inverse=True)
+    if isinstance(target, str):
+        first = np.unique(groups, return_index=True)[1]
+        target = cells[target].to_numpy(dtype=float)[first]
+    elif isinstance(target, dict):
+        target = np.array([target.get(k, np.nan) for k in keys], dtype=float)
+    # floor and cap can also be columns of cells (e.g. different caps by state)
+    if isinstance(floor, str):
+        floor = cells[floor].to_numpy(dtype=float)
+    if isinstance(cap, str):
+        cap = cells[cap].to_numpy(dtype=float)
+    result = capChanges(cells[change_column].to_numpy(dtype=float), cells[premium_column].to_numpy(dtype=float),
+                        groups, target, floor, cap, balance, max_iter, tol)
+    capped = cells.copy()
+    capped['premium'] = cells[premium_column].to_numpy(dtype=float)
+    capped['indicated_change'] = cells[change_column].to_numpy(dtype=float)
+    capped['capped_change'] = result['capped']
+    capped['at_floor'] = result['at_floor']
+    capped['at_cap'] = result['at_cap']
+    groups = pd.DataFrame({
+        group_column: keys,
+        'target': result['target'],
+        'achieved': result['achieved'],
+        'off_balance': result['off_balance'],
+        'iterations': result['iterations'],
+        'feasible': result['feasible'],
+        'converged': result['converged'],
+    })
+    return capped, groups
+
+
+def impactExhibit(capped, groups, group_column='GRCODE'):
+    '''This function summarizes the premium impact of the capped changes of every group (see capCells)
+       Premiums are the on-level premiums of the cells (AdjustedPrem allocated to the cells); cells without an
+       indicated change are left out of every premium total'''
+    # a cell without a change has no indicated or proposed premium, so its premium must not be counted either
+    priced = np.isfinite(capped['indicated_change'].to_numpy()) & np.isfinite(capped['capped_change'].to_numpy())
+    frame = pd.DataFrame({
+        group_column: capped[group_column].to_numpy(),
+        'cells': 1,
+        'premium': np.where(priced, capped['premium'].to_numpy(), np.nan),
+        'indicated_premium': (capped['premium'] * (1 + capped['indicated_change'])).to_numpy(),
+        'proposed_premium': (capped['premium'] * (1 + capped['capped_change'])).to_numpy(),
+        'at_floor': capped['at_floor'].to_numpy(),
+        'at_cap': capped['at_cap'].to_numpy(),
+        'premium_at_floor': np.where(capped['at_floor'], capped['premium'], 0.0),
+        'premium_at_cap': np.where(capped['at_cap'], capped['premium'], 0.0),
+    })
+    exhibit = frame.groupby(group_column, sort=True).sum(min_count=1).reset_index()
+    exhibit['indicated_change'] = exhibit['indicated_premium'] / exhibit['premium'] - 1
+    exhibit['proposed_change'] = exhibit['proposed_premium'] / exhibit['premium'] - 1
+    exhibit['premium_capped_share'] = (exhibit['premium_at_floor'] + exhibit['premium_at_cap']) / exhibit['premium']
+    exhibit = exhibit.merge(groups, on=group_column, how='left')
+    return exhibit.drop(columns=['premium_at_floor', 'premium_at_cap'])
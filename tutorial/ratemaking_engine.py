@@ -0,0 +1,437 @@
+# Vectorized ratemaking engine.
+# This module re-implements the calculations of ratemaking_project.py (chain ladder,
+# parallelogram on-leveling, inflation trending and the loss ratio method) as array
+# operations over the whole book of companies, without any streamlit calls, so that
+# it can be imported by services, batch jobs and worker processes.
+
+import os
+import collections
+import datetime
+import hashlib
+import numpy as np
+import pandas as pd
+
+# our source files (next to this module)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_FILE = os.path.join(BASE_DIR, "wkcomp_pos.csv")
+INFLATION_FILE = os.path.join(BASE_DIR, "605_InflationRates.xlsx")
+
+# loss columns that form development triangles and premium columns (one value per accident year)
+LOSS_COLUMNS = ["CumPaidLoss_D", "IncurLoss_D", "BulkLoss_D"]
+PREMIUM_COLUMNS = ["EarnedPremDIR_D", "EarnedPremCeded_D", "EarnedPremNet_D"]
+
+# averaging methods available for the loss development factors (same names as in the script)
+LDF_METHODS = ["SimpleAvg", "VolumeAvg", "MedialAvg", "GeometricAvg"]
+
+# entries kept in each of the engine's caches (averaged LDFs, level factors, trend factors)
+CACHE_SIZE = 32
+
+# the assumptions used in ratemaking_project.py
+DEFAULT_ASSUMPTIONS = {
+    'ldf_method': "SimpleAvg",
+    'ldf_latest': 5,            # latest 5 accident years in each average
+    'tail': 1.0,
+    'rate_changes': {
+        datetime.date(1988,4,1):0.05,
+        datetime.date(1990,7,1):-0.02,
+        datetime.date(1991,5,1):0.11,
+        datetime.date(1993,8,1):-0.05,
+        datetime.date(1996,8,1):0.15,
+    },
+    'benefit_changes': {
+        datetime.date(1988,4,1):0.05,
+        datetime.date(1990,7,1):-0.02,
+        datetime.date(1991,5,1):0.11,
+        datetime.date(1993,8,1):-0.05,
+        datetime.date(1996,8,1):0.15,
+    },
+    'forecast_date': datetime.date(1999,1,1),
+    'fixed_exp_provision': 0.08,
+    'variable_exp_provision': 0.1,
+    'profit_provision': 0.07,
+    'ulae_ratio': 0.05,
+}
+
+
+def toDate(value):
+    '''This function converts a date given as datetime.date or "YYYY-MM-DD" string to datetime.date'''
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError("invalid date: {!r}".format(value))
+
+
+def toChanges(value, name):
+    '''This function converts a {date: change} mapping (or a list of [date, change] pairs) into a dict sorted by date'''
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        try:
+            items = [(d, c) for d, c in value]
+        except (TypeError, ValueError):
+            raise ValueError("{} must be a mapping of date to change".format(name))
+    changes = {}
+    for d, c in items:
+        try:
+            date = toDate(d)
+        except ValueError:
+            raise ValueError("invalid date in {}: {!r}".format(name, d))
+        try:
+            changes[date] = float(c)
+        except (TypeError, ValueError):
+            raise ValueError("invalid change in {} on {}: {!r}".format(name, date, c))
+        if not np.isfinite(changes[date]):
+            raise ValueError("invalid change in {} on {}: {!r}".format(name, date, c))
+    return dict(sorted(changes.items()))
+
+
+def normalizeAssumptions(assumptions=None):
+    '''This function merges the given assumptions with DEFAULT_ASSUMPTIONS and validates them
+       Here assumptions is of type: dictionary (may come from JSON, so dates can be strings)'''
+    if assumptions is not None and not isinstance(assumptions, dict):
+        raise ValueError("assumptions must be a dictionary")
+    assumptions = dict(assumptions or {})
+    unknown = set(assumptions) - set(DEFAULT_ASSUMPTIONS)
+    if unknown:
+        raise ValueError("unknown assumptions: {}".format(", ".join(sorted(unknown))))
+    result = dict(DEFAULT_ASSUMPTIONS)
+    result.update(assumptions)
+    if result['ldf_method'] not in LDF_METHODS:
+        raise ValueError("ldf_method must be one of {}".format(LDF_METHODS))
+    numeric = ['tail', 'fixed_exp_provision', 'variable_exp_provision', 'profit_provision', 'ulae_ratio']
+    try:
+        result['ldf_latest'] = int(result['ldf_latest'])
+        for key in numeric:
+            result[key] = float(result[key])
+    except (TypeError, ValueError, OverflowError):      # int(inf) raises OverflowError
+        raise ValueError("numeric assumption expected")
+    if not all(np.isfinite(result[key]) for key in numeric):
+        raise ValueError("numeric assumption expected")
+    if result['ldf_latest'] < 1:
+        raise ValueError("ldf_latest must be at least 1")
+    if result['variable_exp_provision'] + result['profit_provision'] >= 1:
+        raise ValueError("variable expense and profit provisions must be less than 1")
+    result['rate_changes'] = toChanges(result['rate_changes'], 'rate_changes')
+    result['benefit_changes'] = toChanges(result['benefit_changes'], 'benefit_changes')
+    result['forecast_date'] = toDate(result['forecast_date'])
+    return result
+
+
+def assumptionsKey(assumptions):
+    '''This function returns a hashable key for a set of normalized assumptions'''
+    return tuple(
+        (key, tuple(value.items()) if isinstance(value, dict) else value)
+        for key, value in sorted(assumptions.items())
+    )
+
+
+def inputHash(*filepaths):
+    '''This function hashes the contents of the input files'''
+    h = hashlib.sha256()
+    for filepath in filepaths:
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def loadDataset(filepath=DATA_FILE):
+    '''This function loads the Schedule P dataset'''
+    return pd.read_csv(filepath)
+
+
+def loadInflation(filepath=INFLATION_FILE, country="United States"):
+    '''This function loads the annual inflation rates (in %) of a country
+       Returns a pandas Series indexed by year'''
+    return countryInflation(pd.read_excel(filepath), country)
+
+
+def countryInflation(inflation_rates, country="United States"):
+    '''This function extracts the annual inflation rates (in %) of a country from the World Bank table
+       Returns a pandas Series indexed by year'''
+    row = inflation_rates[inflation_rates['Country Name'] == country]
+    if row.empty:
+        raise ValueError("no inflation rates for {!r}".format(country))
+    years = [c for c in inflation_rates.columns if str(c).isdigit()]
+    rates = row.iloc[0][years].astype(float)
+    rates.index = [int(y) for y in years]
+    return rates
+
+
+class Book:
+    '''The whole book of companies as arrays
+       Loss columns are stored as (company x accident year x lag) tensors and premium columns as
+       (company x accident year) matrices. Cells after the evaluation year (the lower triangle) are kept
+       in the tensors and masked out by triangle().'''
+    def __init__(self, grcodes, names, years, lags, losses, premiums, posted_reserves):
+        self.grcodes = np.asarray(grcodes)
+        self.names = np.asarray(names)
+        self.years = np.asarray(years)
+        self.lags = np.asarray(lags)
+        self.losses = losses
+        self.premiums = premiums
+        self.posted_reserves = np.asarray(posted_reserves, dtype=float)
+        self.eval_year = int(self.years[-1])
+        # the observed (upper) part of the triangles: AccidentYear + lag - 1 <= evaluation year
+        self.observed = (self.years[:, None] + self.lags[None, :] - 1) <= self.eval_year
+        self._position = {int(g): i for i, g in enumerate(self.grcodes)}
+
+    @classmethod
+    def fromDataset(cls, dataset):
+        '''This function builds a Book from the Schedule P dataframe in one pass'''
+        grcodes, c_idx = np.unique(dataset['GRCODE'].to_numpy(), return_inverse=True)
+        years, a_idx = np.unique(dataset['AccidentYear'].to_numpy(), return_inverse=True)
+        lags, l_idx = np.unique(dataset['DevelopmentLag'].to_numpy(), return_inverse=True)
+        shape = (len(grcodes), len(years), len(lags))
+        losses = {}
+        for column in LOSS_COLUMNS:
+            arr = np.full(shape, np.nan)
+            arr[c_idx, a_idx, l_idx] = dataset[column].to_numpy(dtype=float)
+            losses[column] = arr
+        premiums = {}
+        for column in PREMIUM_COLUMNS:
+            arr = np.full(shape[:2], np.nan)
+            arr[c_idx, a_idx] = dataset[column].to_numpy(dtype=float)
+            premiums[column] = arr
+        names = np.empty(len(grcodes), dtype=object)
+        names[c_idx] = dataset['GRNAME'].to_numpy()
+        posted = np.zeros(len(grcodes))
+        posted[c_idx] = dataset['PostedReserve97_D'].to_numpy(dtype=float)
+        return cls(grcodes, names, years, lags, losses, premiums, posted)
+
+    def index(self, grcodes):
+        '''This function returns the positions of the given GRCODEs in the book'''
+        try:
+            return np.array([self._position[int(g)] for g in np.atleast_1d(grcodes)], dtype=np.intp)
+        except KeyError as e:
+            raise KeyError("unknown GRCODE: {}".format(e.args[0]))
+
+    def triangle(self, column="CumPaidLoss_D"):
+        '''This function returns the (company x accident year x lag) loss triangles with NaN below the diagonal'''
+        return np.where(self.observed, self.losses[column], np.nan)
+
+    def latestDiagonal(self, column="CumPaidLoss_D"):
+        '''This function returns the latest diagonal (company x accident year) and the lag position of each accident year'''
+        latest_lag = self.observed.sum(axis=1) - 1
+        rows = np.arange(len(self.years))
+        return self.losses[column][:, rows, latest_lag], latest_lag
+
+
+def computeLDFTensor(triangle):
+    '''This function computes the Loss Development Factors of all triangles at once
+       Here triangle is a numpy array of shape (company x accident year x lag)'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ldf = triangle[..., 1:] / triangle[..., :-1]
+    ldf[~np.isfinite(ldf)] = np.nan
+    return ldf
+
+
+def _latestMask(valid, n_latest):
+    '''This function keeps only the latest n_latest valid accident years of every column
+       Here valid is a boolean array of shape (company x accident year x column)'''
+    from_latest = np.cumsum(valid[:, ::-1, :], axis=1)[:, ::-1, :]
+    return valid & (from_latest <= n_latest)
+
+
+def computeAverageLDFTensor(ldf, triangle, n_latest=5):
+    '''This function computes the averages of the Loss Development Factors of the latest n_latest accident years
+       for all companies at once, like computeAverageLDF does for one company.
+       Returns a dictionary of arrays of shape (company x development period); NaN where no factor is available'''
+    valid = np.isfinite(ldf) & (ldf != 0)
+    mask = _latestMask(valid, n_latest)
+    count = mask.sum(axis=1)
+    values = np.where(mask, ldf, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = values.sum(axis=1)
+        simple = total / count
+        maximum = np.where(mask, ldf, -np.inf).max(axis=1)
+        minimum = np.where(mask, ldf, np.inf).min(axis=1)
+        medial = np.where(count > 2, (total - maximum - minimum) / (count - 2), (maximum + minimum) / 2)
+        geometric = np.prod(np.where(mask, ldf, 1.0), axis=1) ** (1 / count)
+        # volume-weighted: both the current and the previous cumulative losses have to be available
+        later, earlier = triangle[..., 1:], triangle[..., :-1]
+        vol_valid = np.isfinite(later) & np.isfinite(earlier) & (later != 0) & (earlier != 0)
+        vol_mask = _latestMask(vol_valid, n_latest)
+        volume = np.where(vol_mask, later, 0.0).sum(axis=1) / np.where(vol_mask, earlier, 0.0).sum(axis=1)
+    averages = {
+        'SimpleAvg': simple,
+        'VolumeAvg': volume,
+        'MedialAvg': medial,
+        'GeometricAvg': geometric,
+    }
+    for key in averages:
+        averages[key][count == 0] = np.nan
+        averages[key][~np.isfinite(averages[key])] = np.nan
+    return averages
+
+
+def computeCDFTensor(selected_ldf, tail):
+    '''This function computes the Cumulative Development Factors to ultimate from every lag
+       Here selected_ldf has shape (... x development period) and tail broadcasts against its leading dimensions.
+       Missing factors are taken as 1.0'''
+    selected_ldf = np.where(np.isfinite(selected_ldf), selected_ldf, 1.0)
+    factors = np.concatenate([selected_ldf, np.ones(selected_ldf.shape[:-1] + (1,))], axis=-1)
+    cdf = np.cumprod(factors[..., ::-1], axis=-1)[..., ::-1]
+    return cdf * np.asarray(tail, dtype=float)[..., None]
+
+
+def projectUltimates(latest, latest_lag, cdf):
+    '''This function projects ultimate losses from the latest diagonal
+       latest has shape (... x accident year), latest_lag gives the lag position of each accident year and
+       cdf has shape (... x lag)'''
+    return latest * np.take(cdf, latest_lag, axis=-1)
+
+
+def monthsBetween(date1, date2):
+    '''This function calculates the difference between 2 given dates in years (at monthly precision),
+       like months_between in the script'''
+    return ((date1.year*12+date1.month) - (date2.year*12+date2.month)) / 12
+
+
+def parallelogramPortions(change_dates, years, T=1, E=1):
+    '''This function calculates the portions of each year earned at each level of a list of changes
+       (parallelogram method with the generalized formula of Richard A. Bill).
+       Returns an array of shape (year x level) where level 0 is the level before the first change'''
+    D = np.array([[monthsBetween(d, datetime.date(int(y),1,1)) for d in change_dates] for y in years], dtype=float)
+    D = D.reshape(len(years), len(change_dates))
+    A = D + T
+    B = np.maximum(A - E, 0)
+    C = np.maximum(D, 0)
+    # portion earned after each change
+    after = 1 - (A**2 - B**2 - C**2) / (2*E*T)
+    after = np.where(D <= -T, 1.0, np.where(D >= E, 0.0, after))
+    after = np.concatenate([np.ones((len(years), 1)), after, np.zeros((len(years), 1))], axis=1)
+    return after[:, :-1] - after[:, 1:]
+
+
+def levelFactors(changes, years):
+    '''This function calculates the factors that bring each year to the current level of a set of changes
+       (on-level factors for rate changes, adjustment factors for benefit changes).
+       Here changes is a dictionary {date: change} sorted by date'''
+    cum_index = np.cumprod([1.0] + [1 + c for c in changes.values()])
+    portions = parallelogramPortions(list(changes.keys()), years)
+    return cum_index[-1] / (portions @ cum_index)
+
+
+def inflationAverages(rates, years):
+    '''This function averages the inflation rates from each year up to the last year'''
+    values = np.array([rates[int(y)] for y in years], dtype=float)
+    return np.cumsum(values[::-1])[::-1] / np.arange(len(values), 0, -1)
+
+
+def trendPeriods(years, forecast_date):
+    '''This function calculates the loss and premium trend periods (in years) to the forecast date
+       Losses are trended from the middle of the accident year and premiums from its start, as in the script'''
+    loss_period = np.array([monthsBetween(forecast_date, datetime.date(int(y),7,1)) for y in years])
+    prem_period = np.array([monthsBetween(forecast_date, datetime.date(int(y),1,1)) for y in years])
+    return loss_period, prem_period
+
+
+class _LRUCache:
+    '''A dictionary keeping only the maxsize most recently used entries'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, compute):
+        '''This function returns the cached value of key, computing (and caching) it when missing'''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = self.entries[key] = compute()
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class PricingEngine:
+    '''A warm, in-memory engine for indications
+       It keeps the parsed dataset, the paid loss triangles, the averaged LDFs and the inflation averages resident,
+       so that an indication only costs a few array operations. The triangle and LDF tensors can be given
+       (e.g. views of shared memory) instead of being computed from the book. input_hash identifies the source data
+       the book was built from (see inputHash); it is None when unknown.'''
+    def __init__(self, book, inflation, column="CumPaidLoss_D", triangle=None, ldf=None, input_hash=None):
+        self.book = book
+        self.inflation = inflation
+        self.column = column
+        self.input_hash = input_hash
+        self.triangle = book.triangle(column) if triangle is None else triangle
+        self.ldf = computeLDFTensor(self.triangle) if ldf is None else ldf
+        self.latest, self.latest_lag = book.latestDiagonal(column)
+        self.inf_avg = inflationAverages(inflation, book.years)
+        # bounded: in the pricing service the keys come from the requests
+        self._avg_ldf = _LRUCache(CACHE_SIZE)
+        self._levels = _LRUCache(CACHE_SIZE)
+        self._trends = _LRUCache(CACHE_SIZE)
+
+    @classmethod
+    def load(cls, data_file=DATA_FILE, inflation_file=INFLATION_FILE, column="CumPaidLoss_D"):
+        '''This function builds an engine from the source files'''
+        input_hash = inputHash(data_file, inflation_file)
+        return cls(Book.fromDataset(loadDataset(data_file)), loadInflation(inflation_file), column,
+                   input_hash=input_hash)
+
+    def averageLDF(self, n_latest=5):
+        '''This function returns (and caches) the averaged LDFs of every company'''
+        return self._avg_ldf.get(n_latest, lambda: computeAverageLDFTensor(self.ldf, self.triangle, n_latest))
+
+    def changeFactors(self, changes):
+        '''This function returns (and caches) the factors that bring every accident year to the current level of changes'''
+        return self._levels.get(tuple(changes.items()), lambda: levelFactors(changes, self.book.years))
+
+    def trendFactors(self, forecast_date):
+        '''This function returns (and caches) the loss and premium inflation trend factors to the forecast date'''
+        def compute():
+            loss_period, prem_period = trendPeriods(self.book.years, forecast_date)
+            rate = 1 + 0.01*self.inf_avg
+            return rate**loss_period, rate**prem_period
+        return self._trends.get(forecast_date, compute)
+
+    def indicate(self, grcodes, assumptions):
+        '''This function computes the overall indicated rate change for a batch of requests in one vectorized pass
+           grcodes is a list of GRCODEs and assumptions is a list (same length) of normalized assumptions.
+           Returns a dictionary of arrays, with one row per request'''
+        idx = self.book.index(grcodes)
+        if len(assumptions) != len(idx):
+            raise ValueError("one set of assumptions is needed per GRCODE")
+        selected_Ldf = np.stack([self.averageLDF(a['ldf_latest'])[a['ldf_method']][i] for i, a in zip(idx, assumptions)])
+        tail = np.array([a['tail'] for a in assumptions])
+        cdf = computeCDFTensor(selected_Ldf, tail)
+        proj_ultLosses = projectUltimates(self.latest[idx], self.latest_lag, cdf)
+        onlevel = np.stack([self.changeFactors(a['rate_changes']) for a in assumptions])
+        adjusts = np.stack([self.changeFactors(a['benefit_changes']) for a in assumptions])
+        trends = [self.trendFactors(a['forecast_date']) for a in assumptions]
+        loss_inf_factor = np.stack([t[0] for t in trends])
+        prem_inf_factor = np.stack([t[1] for t in trends])
+
+        AdjustedPrem = self.book.premiums['EarnedPremNet_D'][idx] * onlevel
+        AdjustedLosses = proj_ultLosses * adjusts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            loss_ratio = (AdjustedLosses*loss_inf_factor) / (AdjustedPrem*prem_inf_factor)
+        fixed = np.array([a['fixed_exp_provision'] for a in assumptions])
+        variable = np.array([a['variable_exp_provision'] for a in assumptions])
+        profit = np.array([a['profit_provision'] for a in assumptions])
+        ulae = np.array([a['ulae_ratio'] for a in assumptions])
+        avg_loss_ratio = loss_ratio.mean(axis=1) * (1 + ulae)
+        permissibleLR = 1 - (variable + profit)
+        indicated_avg_rate_change = (avg_loss_ratio + fixed) / permissibleLR - 1
+        return {
+            'GRCODE': self.book.grcodes[idx],
+            'selected_Ldf': selected_Ldf,
+            'cdf': cdf,
+            'proj_ultLosses': proj_ultLosses,
+            'onlevel': onlevel,
+            'AdjustedPrem': AdjustedPrem,
+            'AdjustedLosses': AdjustedLosses,
+            'loss_ratio': loss_ratio,
+            'avg_loss_ratio': avg_loss_ratio,
+            'permissibleLR': permissibleLR,
+            'indicated_avg_rate_change': indicated_avg_rate_change,
+        }
@@ -21,9 +21,18 @@ st.subheader("Pricing(Ratemaking) Worker's Compensation Premiums using Actuarial
 filepath = "./wkcomp_pos.csv"
 
 # load the dataset
-@st.cache_data # for faster execution
+# the data version manager parses the source files once and rebuilds them in the background when they change,
+# every rerun of the script takes the current snapshot (see data_versions.py)
+from data_versions import DataVersionManager
+
+@st.cache_resource # one manager for all sessions
+def data_manager():
+    return DataVersionManager(filepath, "./605_InflationRates.xlsx").start()
+
+snapshot = data_manager().current()
+
 def load_data():
-    df = pd.DataFrame(pd.read_csv(filepath))
+    df = snapshot.dataset.copy() # the snapshot is shared, so work on a copy
     return df
 '''##### - This is our dataset'''
 dataset = load_data()
@@ -886,7 +895,7 @@ for i in adjusts.keys():
 # Lets work on Inflation Rates first
 filepath = "./605_InflationRates.xlsx"
 
-inflation_rates = pd.read_excel(filepath)
+inflation_rates = snapshot.inflation_rates # already parsed by the data version manager
 inflation_rates
 
 # inflation rates in USA
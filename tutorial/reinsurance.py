@@ -0,0 +1,212 @@
+# Reinsurance netting.
+# The indication uses EarnedPremNet_D only. This module starts from the gross (direct and assumed) business and nets
+# it down under a proposed treaty, so treaty structures can be compared on the indication. Schedule P losses are net
+# of the companies' actual reinsurance, so the gross losses are estimated by grossing the net losses up with the
+# historical cession ratio (EarnedPremCeded_D / EarnedPremDIR_D): gross = net / (1 - ceded share). This assumes the
+# actual programs ceded losses in proportion to premium, which makes each year's gross loss ratio on EarnedPremDIR_D
+# equal to its net loss ratio on EarnedPremNet_D. Years without a usable ceded share (ceded share of 1 or more, no
+# direct premium) have no gross losses (NaN); negative ceded premiums count as no cession.
+#
+# Every treaty is evaluated over a grid of its terms for all companies at once:
+#   {'type': 'quota_share', 'cession': [0.2, 0.4], 'commission': 0.3}
+#   {'type': 'xol', 'retention': [250, 500], 'limit': [500, 1000], 'severity': {'dist': 'lognormal', 'mean': 40, 'cv': 4},
+#    'loading': 0.3}
+#   {'type': 'stop_loss', 'attachment': [0.7, 0.8], 'limit': [0.2, 0.5], 'cv': 0.15, 'loading': 0.3}
+# Any term can be a single value or a list; the grid is every combination. Amounts are in the units of the data
+# (thousands of dollars) at the forecast level; stop-loss attachments and limits are loss ratios of the gross premium.
+#
+# Schedule P has no claim-level data, so the per-occurrence layer uses a simulated severity distribution and the
+# stop-loss a simulated aggregate loss distribution (both unit-mean samples scaled to each company and accident year).
+# The severity of an excess of loss treaty must give its mean (in thousands), and layers reaching beyond the largest
+# simulated loss are rejected, because the sample cannot tell their limits apart.
+# Non-proportional treaties are priced at their expected ceded losses times (1 + loading).
+#
+# Usage:
+#   engine = PricingEngine.load()
+#   exhibit = compareTreaties(engine, {'QS 30%': {'type': 'quota_share', 'cession': 0.3, 'commission': 0.3},
+#                                      'XoL': {'type': 'xol', 'retention': [250, 500], 'limit': 1000,
+#                                              'severity': {'dist': 'lognormal', 'mean': 40, 'cv': 4}}})
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+from indication_simulation import sampleInput
+
+# treaty type -> its grid terms
+TREATY_TERMS = {
+    'quota_share': ['cession', 'commission'],
+    'xol': ['retention', 'limit'],
+    'stop_loss': ['attachment', 'limit'],
+}
+
+N_SIMS = 100000
+
+
+def historicalCessionRatio(book):
+    '''This function returns the share of the direct earned premium ceded under the companies' actual programs
+       (company x accident year); NaN where it is 1 or more or there is no direct premium, 0 where it is negative'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = book.premiums['EarnedPremCeded_D'] / book.premiums['EarnedPremDIR_D']
+        return np.where(np.isfinite(ratio) & (ratio < 1), np.maximum(ratio, 0.0), np.nan)
+
+
+def grossUpFactor(book):
+    '''This function returns the factor 1 / (1 - historical ceded share) that turns the (net) Schedule P losses into
+       estimated gross losses (company x accident year)'''
+    return 1 / (1 - historicalCessionRatio(book))
+
+
+def netTriangles(book, ceded_ratio, column="CumPaidLoss_D"):
+    '''This function derives the gross and net loss triangles for a (company x accident year) ceded loss ratio
+       The gross triangle grosses the Schedule P (net) losses up with grossUpFactor. The ultimate cession of each
+       accident year is applied to all its development ages, which is exact for a quota share and an approximation
+       for excess treaties (whose recoveries develop later than the ground-up losses)'''
+    gross = book.triangle(column) * grossUpFactor(book)[..., None]
+    ceded_ratio = np.where(np.isfinite(ceded_ratio), ceded_ratio, 0.0)
+    return gross, gross * (1 - ceded_ratio[..., None])
+
+
+def treatyGrid(treaty):
+    '''This function expands the terms of a treaty spec into a grid
+       Returns a dictionary term -> array, one value per grid point'''
+    kind = treaty.get('type')
+    if kind not in TREATY_TERMS:
+        raise ValueError("treaty type must be one of {}".format(list(TREATY_TERMS)))
+    defaults = {'commission': 0.0}
+    values = []
+    for term in TREATY_TERMS[kind]:
+        value = treaty.get(term, defaults.get(term))
+        if value is None:
+            raise ValueError("{} treaty needs {!r}".format(kind, term))
+        values.append(np.atleast_1d(np.asarray(value, dtype=float)))
+    grid = np.array(list(itertools.product(*values)), dtype=float)
+    return {term: grid[:, k] for k, term in enumerate(TREATY_TERMS[kind])}
+
+
+def unitSample(rng, spec, size=N_SIMS):
+    '''This function draws a sorted sample with mean exactly 1 from a distribution spec (see sampleInput)
+       Returns the sample and its cumulative sums, for limitedExpectedValue'''
+    sample = np.sort(sampleInput(rng, spec, 1.0, size))
+    sample /= sample.mean()
+    return sample, np.concatenate([[0.0], np.cumsum(sample)])
+
+
+def limitedExpectedValue(curve, limit):
+    '''This function computes E[min(X, limit)] of a sample from unitSample, for an array of limits'''
+    sample, cumsum = curve
+    limit = np.asarray(limit, dtype=float)
+    below = np.searchsorted(sample, limit, side='right')
+    return (cumsum[below] + limit * (len(sample) - below)) / len(sample)
+
+
+def layerShare(curve, attachment, limit):
+    '''This function returns the expected share of a unit-mean loss in the layer limit xs attachment'''
+    return limitedExpectedValue(curve, attachment + limit) - limitedExpectedValue(curve, attachment)
+
+
+def treatyCessions(engine, treaty, grcodes=None, assumptions=None, n_sims=N_SIMS, seed=None):
+    '''This function computes the gross and ceded trended losses and premiums of a treaty for every grid point
+       Returns a dictionary with the grid, the gross (company x accident year) arrays and the ceded
+       (company x accident year x grid point) arrays'''
+    a = engine_lib.normalizeAssumptions(assumptions)
+    if grcodes is None:
+        grcodes = engine.book.grcodes
+    idx = engine.book.index(grcodes)
+    rng = np.random.default_rng(seed)
+    grid = treatyGrid(treaty)
+    results = engine.indicate(grcodes, [a]*len(idx))
+    loss_inf_factor, prem_inf_factor = engine.trendFactors(a['forecast_date'])
+    losses = results['AdjustedLosses'] * loss_inf_factor * grossUpFactor(engine.book)[idx]
+    premium = engine.book.premiums['EarnedPremDIR_D'][idx] * results['onlevel'] * prem_inf_factor
+
+    kind = treaty['type']
+    loading = float(treaty.get('loading', 0.0))
+    commission = np.zeros(len(grid[TREATY_TERMS[kind][0]]))
+    if kind == 'quota_share':
+        ceded_losses = losses[..., None] * grid['cession']
+        ceded_premium = premium[..., None] * grid['cession']
+        commission = grid['commission']
+    elif kind == 'xol':
+        # per-occurrence layer: the same share of every company's losses, from the severity distribution
+        severity = dict(treaty.get('severity') or {})
+        if 'mean' not in severity:
+            raise ValueError("xol treaty needs a severity with its 'mean' (in thousands)")
+        mean = float(severity.pop('mean'))
+        severity.setdefault('dist', 'lognormal')
+        severity.setdefault('cv', 4.0)
+        curve = unitSample(rng, severity, n_sims)
+        top = (grid['retention'] + grid['limit']) / mean
+        if np.any(top > curve[0][-1]):
+            raise ValueError("xol layer beyond the largest simulated loss ({:.0f}): increase n_sims or check the "
+                             "severity mean".format(curve[0][-1] * mean))
+        share = layerShare(curve, grid['retention'] / mean, grid['limit'] / mean)
+        ceded_losses = losses[..., None] * share
+        ceded_premium = ceded_losses * (1 + loading)
+    else:
+        # aggregate stop-loss on each accident year: the attachment and limit scale with the premium
+        curve = unitSample(rng, {'dist': 'lognormal', 'cv': float(treaty.get('cv', 0.15))}, n_sims)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exposure = (premium / losses)[..., None]
+            share = layerShare(curve, grid['attachment'] * exposure, grid['limit'] * exposure)
+        ceded_losses = losses[..., None] * np.where(np.isfinite(share), share, 0.0)
+        ceded_premium = ceded_losses * (1 + loading)
+    return {
+        'GRCODE': engine.book.grcodes[idx],
+        'grid': grid,
+        'losses': losses,
+        'premium': premium,
+        'ceded_losses': ceded_losses,
+        'ceded_premium': ceded_premium,
+        'commission': commission,
+        'assumptions': a,
+    }
+
+
+def treatyIndications(engine, treaty, grcodes=None, assumptions=None, n_sims=N_SIMS, seed=None):
+    '''This function computes the gross and net-of-treaty indications of every company at every grid point
+       gross_rate_change is the loss ratio method on the grossed-up losses and the direct premium. net_rate_change
+       keeps the losses, the ULAE and the expense and profit provisions on the direct premium and adds the net cost of
+       reinsurance (ceded premium less commission less expected ceded losses, reinsurance_cost_ratio) to the loss
+       ratio, so it is the change of the direct rates that also pays for the treaty. net_loss_ratio is the loss ratio
+       of the net book (net losses over the direct premium less ceded premium plus commission), for information.
+       Returns a long dataframe with one row per company and grid point'''
+    c = treatyCessions(engine, treaty, grcodes, assumptions, n_sims, seed)
+    a = c['assumptions']
+    losses = c['losses'][..., None]
+    premium = c['premium'][..., None]
+    net_losses = losses - c['ceded_losses']
+    net_premium = premium - c['ceded_premium'] * (1 - c['commission'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gross_ratio = (losses / premium).mean(axis=1)
+        cost_ratio = ((premium - net_premium - c['ceded_losses']) / premium).mean(axis=1)
+        net_loss_ratio = (net_losses / net_premium).mean(axis=1)
+        ceded_share = c['ceded_losses'].sum(axis=1) / losses.sum(axis=1)
+    permissibleLR = 1 - (a['variable_exp_provision'] + a['profit_provision'])
+
+    def indication(ratio, cost=0.0):
+        # the company still settles the ceded claims, so ULAE applies to the direct losses, not to the treaty's cost
+        return (ratio * (1 + a['ulae_ratio']) + cost + a['fixed_exp_provision']) / permissibleLR - 1
+
+    n_companies, n_points = net_loss_ratio.shape
+    exhibit = pd.DataFrame({'GRCODE': np.repeat(c['GRCODE'], n_points)})
+    for term, values in c['grid'].items():
+        exhibit[term] = np.tile(values, n_companies)
+    exhibit['ceded_loss_share'] = ceded_share.ravel()
+    exhibit['net_loss_ratio'] = net_loss_ratio.ravel()
+    exhibit['reinsurance_cost_ratio'] = cost_ratio.ravel()
+    exhibit['gross_rate_change'] = np.repeat(indication(gross_ratio[:, 0]), n_points)
+    exhibit['net_rate_change'] = indication(gross_ratio, cost_ratio).ravel()
+    return exhibit
+
+
+def compareTreaties(engine, treaties, grcodes=None, assumptions=None, n_sims=N_SIMS, seed=None):
+    '''This function evaluates several treaty specs ({name: spec}) and stacks their exhibits'''
+    exhibits = []
+    for name, treaty in treaties.items():
+        exhibit = treatyIndications(engine, treaty, grcodes, assumptions, n_sims, seed)
+        exhibit.insert(1, 'treaty', name)
+        exhibits.append(exhibit)
+    return pd.concat(exhibits, ignore_index=True)
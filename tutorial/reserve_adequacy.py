@@ -0,0 +1,75 @@
+# Reserve adequacy reconciliation.
+# Compares each group's posted reserves (PostedReserve97_D) with the unpaid losses implied by the chain ladder
+# ultimates (projected ultimate losses minus the latest paid diagonal), for the paid and incurred methods,
+# for the whole book in one vectorized job.
+#
+# Usage:
+#   book = Book.fromDataset(loadDataset())
+#   exhibit = reserveAdequacy(book, ldf_method="VolumeAvg")
+#   exhibit.sort_values("adequacy_paid")
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# development methods: name -> loss column the chain ladder is run on
+METHODS = {
+    'paid': "CumPaidLoss_D",
+    'incurred': "IncurLoss_D",
+}
+
+
+def chainLadderUltimates(book, column="CumPaidLoss_D", ldf_method="VolumeAvg", n_latest=5, tail=1.0):
+    '''This function projects the ultimate losses of every company and accident year with the chain ladder method
+       Returns an array of shape (company x accident year)'''
+    triangle = book.triangle(column)
+    ldf = engine_lib.computeLDFTensor(triangle)
+    selected_Ldf = engine_lib.computeAverageLDFTensor(ldf, triangle, n_latest)[ldf_method]
+    cdf = engine_lib.computeCDFTensor(selected_Ldf, np.full(len(book.grcodes), tail))
+    latest, latest_lag = book.latestDiagonal(column)
+    return engine_lib.projectUltimates(latest, latest_lag, cdf)
+
+
+def impliedUnpaid(book, ldf_method="VolumeAvg", n_latest=5, tail=1.0):
+    '''This function computes the unpaid losses implied by the chain ladder ultimates of every method
+       (ultimate losses minus the latest paid diagonal, summed over accident years).
+       Returns a dictionary method -> array of shape (company,)'''
+    paid_to_date, _ = book.latestDiagonal("CumPaidLoss_D")
+    unpaid = {}
+    for method, column in METHODS.items():
+        ultimates = chainLadderUltimates(book, column, ldf_method, n_latest, tail)
+        unpaid[method] = np.nansum(ultimates - paid_to_date, axis=1)
+    return unpaid
+
+
+def simulatedPercentile(posted, unpaid_sims):
+    '''This function finds where the posted reserves fall in simulated distributions of unpaid losses
+       posted has shape (company,) and unpaid_sims has shape (company x simulation).
+       Returns the percentile (0-100) of the posted reserve in each company's distribution'''
+    return (unpaid_sims <= np.asarray(posted)[:, None]).mean(axis=1) * 100
+
+
+def reserveAdequacy(book, ldf_method="VolumeAvg", n_latest=5, tail=1.0, unpaid_sims=None):
+    '''This function builds the reserve adequacy exhibit for every company of the book
+       Adequacy ratio = posted reserves / implied unpaid losses (above 1 means the posted reserves are redundant).
+       book_percentile ranks each company's paid adequacy ratio within the book. If unpaid_sims (company x simulation)
+       is given, the percentile of the posted reserves within the simulated unpaid losses is added as well'''
+    posted = book.posted_reserves
+    unpaid = impliedUnpaid(book, ldf_method, n_latest, tail)
+    exhibit = pd.DataFrame({
+        'GRCODE': book.grcodes,
+        'GRNAME': book.names,
+        'PostedReserve97_D': posted,
+    })
+    for method in METHODS:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = posted / unpaid[method]
+        exhibit['unpaid_' + method] = unpaid[method]
+        # no ratio when the method implies no unpaid losses
+        exhibit['adequacy_' + method] = np.where(np.isfinite(ratio) & (unpaid[method] > 0), ratio, np.nan)
+        exhibit['difference_' + method] = posted - unpaid[method]
+    exhibit['book_percentile'] = exhibit['adequacy_paid'].rank(pct=True) * 100
+    if unpaid_sims is not None:
+        exhibit['simulated_percentile'] = simulatedPercentile(posted, unpaid_sims)
+    return exhibit
@@ -0,0 +1,197 @@
+# Persistent results store.
+# Records every run of the engine in a local SQLite database: the hash of the engine's input data, the loss column
+# it develops, the hash of the assumptions, the per-company intermediate exhibits by accident year and the final
+# indications. A run whose (input hash, loss column, assumptions hash) is already stored is served from the database
+# instead of being recomputed.
+#
+# Usage:
+#   store = ResultsStore("results.sqlite")
+#   engine = PricingEngine.load()
+#   run_id = store.runBook(engine, {'ldf_method': 'VolumeAvg'})
+#   store.history(86, last=20)
+
+import datetime
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# intermediate exhibits stored per company and accident year
+EXHIBITS = ['proj_ultLosses', 'onlevel', 'AdjustedPrem', 'AdjustedLosses', 'loss_ratio']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    loss_column TEXT NOT NULL DEFAULT 'CumPaidLoss_D',
+    assumptions_hash TEXT NOT NULL,
+    assumptions TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS indications (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    GRCODE INTEGER NOT NULL,
+    avg_loss_ratio REAL,
+    permissibleLR REAL,
+    indicated_avg_rate_change REAL,
+    PRIMARY KEY (GRCODE, run_id)
+);
+
+CREATE TABLE IF NOT EXISTS exhibits (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    GRCODE INTEGER NOT NULL,
+    AY INTEGER NOT NULL,
+    proj_ultLosses REAL,
+    onlevel REAL,
+    AdjustedPrem REAL,
+    AdjustedLosses REAL,
+    loss_ratio REAL,
+    PRIMARY KEY (GRCODE, run_id, AY)
+);
+CREATE INDEX IF NOT EXISTS exhibits_run ON exhibits (run_id);
+"""
+
+
+# runs are keyed by the input data, the developed loss column and the assumptions
+_RUNS_KEY = """
+DROP INDEX IF EXISTS runs_inputs;
+CREATE UNIQUE INDEX IF NOT EXISTS runs_key ON runs (input_hash, loss_column, assumptions_hash);
+"""
+
+inputHash = engine_lib.inputHash
+
+
+def dataHash(engine):
+    '''This function hashes the arrays an engine computes from, for engines built without a known input hash'''
+    book = engine.book
+    h = hashlib.sha256()
+    arrays = [book.grcodes, book.years, book.lags, book.posted_reserves,
+              engine.inflation.index.to_numpy(), engine.inflation.to_numpy(dtype=float)]
+    arrays += [book.losses[c] for c in sorted(book.losses)] + [book.premiums[c] for c in sorted(book.premiums)]
+    for array in arrays:
+        h.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def engineInputHash(engine):
+    '''This function returns the hash of the data an engine was built from'''
+    return engine.input_hash if engine.input_hash is not None else dataHash(engine)
+
+
+def assumptionsJSON(assumptions):
+    '''This function serializes normalized assumptions to canonical JSON (dates as ISO strings)'''
+    def convert(value):
+        if isinstance(value, dict):
+            return {k.isoformat() if isinstance(k, datetime.date) else k: convert(v) for k, v in value.items()}
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        return value
+    return json.dumps(convert(assumptions), sort_keys=True)
+
+
+def assumptionsHash(assumptions):
+    '''This function hashes a set of normalized assumptions'''
+    return hashlib.sha256(assumptionsJSON(assumptions).encode()).hexdigest()
+
+
+def _nullable(values):
+    '''This function converts an array to python floats with NaN as None, for SQLite'''
+    return [None if not np.isfinite(v) else float(v) for v in values]
+
+
+class ResultsStore:
+    '''A SQLite database of runs, exhibits and indications'''
+    def __init__(self, path="results.sqlite"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        # databases created before runs were keyed by loss column
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(runs)")]
+        if 'loss_column' not in columns:
+            self.conn.execute("ALTER TABLE runs ADD COLUMN loss_column TEXT NOT NULL DEFAULT 'CumPaidLoss_D'")
+        self.conn.executescript(_RUNS_KEY)
+
+    def close(self):
+        self.conn.close()
+
+    def findRun(self, input_hash, assumptions_hash, loss_column="CumPaidLoss_D"):
+        '''This function returns the run_id of a stored (input hash, loss column, assumptions hash) combination, or None'''
+        row = self.conn.execute(
+            "SELECT run_id FROM runs WHERE input_hash = ? AND loss_column = ? AND assumptions_hash = ?",
+            (input_hash, loss_column, assumptions_hash),
+        ).fetchone()
+        return row[0] if row else None
+
+    def saveRun(self, input_hash, assumptions, years, results, loss_column="CumPaidLoss_D"):
+        '''This function stores the results of PricingEngine.indicate for one set of assumptions in a single transaction
+           Returns the new run_id'''
+        grcodes = [int(g) for g in results['GRCODE']]
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO runs (created_at, input_hash, loss_column, assumptions_hash, assumptions) VALUES (?, ?, ?, ?, ?)",
+                (datetime.datetime.now().isoformat(timespec="seconds"), input_hash, loss_column,
+                 assumptionsHash(assumptions), assumptionsJSON(assumptions)),
+            )
+            run_id = cur.lastrowid
+            self.conn.executemany(
+                "INSERT INTO indications VALUES (?, ?, ?, ?, ?)",
+                zip([run_id]*len(grcodes), grcodes,
+                    _nullable(results['avg_loss_ratio']),
+                    _nullable(results['permissibleLR']),
+                    _nullable(results['indicated_avg_rate_change'])),
+            )
+            n_years = len(years)
+            columns = [_nullable(results[key].ravel()) for key in EXHIBITS]
+            self.conn.executemany(
+                "INSERT INTO exhibits VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                zip([run_id]*(len(grcodes)*n_years),
+                    np.repeat(grcodes, n_years).tolist(),
+                    np.tile([int(y) for y in years], len(grcodes)).tolist(),
+                    *columns),
+            )
+        return run_id
+
+    def runBook(self, engine, assumptions=None, input_hash=None):
+        '''This function returns the run_id for the whole book under the given assumptions,
+           computing and storing it only if the (input hash, loss column, assumptions hash) combination is new.
+           input_hash defaults to the hash of the engine's own input data (see engineInputHash)'''
+        assumptions = engine_lib.normalizeAssumptions(assumptions)
+        if input_hash is None:
+            input_hash = engineInputHash(engine)
+        run_id = self.findRun(input_hash, assumptionsHash(assumptions), engine.column)
+        if run_id is not None:
+            return run_id
+        grcodes = engine.book.grcodes
+        results = engine.indicate(grcodes, [assumptions]*len(grcodes))
+        return self.saveRun(input_hash, assumptions, engine.book.years, results, engine.column)
+
+    def indications(self, run_id):
+        '''This function returns the indications of a run as a dataframe'''
+        return pd.read_sql_query(
+            "SELECT * FROM indications WHERE run_id = ? ORDER BY GRCODE", self.conn, params=(run_id,)
+        )
+
+    def exhibits(self, run_id, grcode=None):
+        '''This function returns the intermediate exhibits of a run (optionally for one company) as a dataframe'''
+        if grcode is None:
+            query, params = "SELECT * FROM exhibits WHERE run_id = ? ORDER BY GRCODE, AY", (run_id,)
+        else:
+            query, params = "SELECT * FROM exhibits WHERE GRCODE = ? AND run_id = ? ORDER BY AY", (int(grcode), run_id)
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def history(self, grcode, last=20):
+        '''This function returns how a company's indication moved across its last runs'''
+        return pd.read_sql_query(
+            """SELECT r.run_id, r.created_at, r.loss_column, r.assumptions_hash, i.avg_loss_ratio, i.indicated_avg_rate_change
+               FROM indications i JOIN runs r ON r.run_id = i.run_id
+               WHERE i.GRCODE = ?
+               ORDER BY i.run_id DESC LIMIT ?""",
+            self.conn, params=(int(grcode), int(last)),
+        )
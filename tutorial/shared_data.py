@@ -0,0 +1,179 @@
+# Shared-memory data plane for process pools.
+# The parent process loads the dataset and the engine once and copies every array (the dataset columns, the
+# (company x accident year x lag) loss tensors, the paid triangle and LDF tensors, premiums and inflation) into one
+# multiprocessing.shared_memory block. Workers attach to the block by name and rebuild the Book and the PricingEngine
+# on zero-copy, read-only numpy views, so memory stays flat with the number of workers and tasks only need to carry
+# small payloads (GRCODEs, indices, assumptions).
+#
+# Usage:
+#   with shareEngine(engine, dataset) as shared:
+#       with ProcessPoolExecutor(8, initializer=initWorker, initargs=(shared.manifest,)) as pool:
+#           pool.map(task, chunks_of_grcodes)
+#   def task(grcodes):
+#       engine = workerEngine()
+
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# byte alignment of every array in the block
+_ALIGN = 64
+
+# the attached data of a worker process
+_worker = None
+
+
+def _attachBlock(name):
+    # workers must not unlink the block on exit; it belongs to the parent
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+class SharedArrays:
+    '''A set of named numpy arrays in one shared memory block
+       The owner creates the block with SharedArrays.create and must unlink it when done (or use it as a context
+       manager); other processes attach with SharedArrays.attach(manifest). The manifest is a small picklable dictionary.'''
+    def __init__(self, shm, layout, meta, owner):
+        self.shm = shm
+        self.layout = layout
+        self.meta = meta
+        self.owner = owner
+        self.arrays = {}
+        for key, (offset, shape, dtype) in layout.items():
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            if not owner:
+                view.flags.writeable = False
+            self.arrays[key] = view
+
+    @classmethod
+    def create(cls, arrays, meta=None):
+        '''This function copies a dictionary of arrays into a new shared memory block'''
+        layout = {}
+        size = 0
+        arrays = {key: np.ascontiguousarray(value) for key, value in arrays.items()}
+        for key, value in arrays.items():
+            if value.dtype.hasobject:
+                raise TypeError("cannot share an object array: {}".format(key))
+            size = -(-size // _ALIGN) * _ALIGN
+            layout[key] = (size, value.shape, value.dtype.str)
+            size += value.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shared = cls(shm, layout, dict(meta or {}), owner=True)
+        for key, value in arrays.items():
+            shared.arrays[key][...] = value
+        return shared
+
+    @classmethod
+    def attach(cls, manifest):
+        '''This function attaches to the block described by a manifest (read-only views)'''
+        return cls(_attachBlock(manifest['name']), manifest['layout'], manifest['meta'], owner=False)
+
+    @property
+    def manifest(self):
+        return {'name': self.shm.name, 'layout': self.layout, 'meta': self.meta}
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+
+def _datasetArrays(dataset):
+    arrays = {}
+    for column in dataset.columns:
+        values = dataset[column].to_numpy()
+        if values.dtype.kind not in 'biuf':
+            values = values.astype(str)         # text columns as fixed-width strings
+        arrays['dataset/' + column] = values
+    return arrays
+
+
+def shareEngine(engine, dataset=None):
+    '''This function copies the arrays of an engine (and optionally the source dataset) into shared memory
+       Returns the owning SharedArrays; pass its manifest to initWorker'''
+    book = engine.book
+    arrays = {
+        'book/grcodes': book.grcodes,
+        'book/names': book.names.astype(str),
+        'book/years': book.years,
+        'book/lags': book.lags,
+        'book/posted_reserves': book.posted_reserves,
+        'engine/triangle': engine.triangle,
+        'engine/ldf': engine.ldf,
+        'inflation/years': engine.inflation.index.to_numpy(dtype=np.int64),
+        'inflation/rates': engine.inflation.to_numpy(dtype=float),
+    }
+    for column, value in book.losses.items():
+        arrays['losses/' + column] = value
+    for column, value in book.premiums.items():
+        arrays['premiums/' + column] = value
+    meta = {'column': engine.column, 'input_hash': engine.input_hash, 'dataset_columns': []}
+    if dataset is not None:
+        arrays.update(_datasetArrays(dataset))
+        meta['dataset_columns'] = list(dataset.columns)
+    return SharedArrays.create(arrays, meta)
+
+
+def engineFromShared(shared):
+    '''This function rebuilds the Book and the PricingEngine on the views of a SharedArrays'''
+    def group(prefix):
+        return {key[len(prefix):]: value for key, value in shared.arrays.items() if key.startswith(prefix)}
+    book = engine_lib.Book(shared['book/grcodes'], shared['book/names'], shared['book/years'], shared['book/lags'],
+                           group('losses/'), group('premiums/'), shared['book/posted_reserves'])
+    inflation = pd.Series(shared['inflation/rates'], index=shared['inflation/years'])
+    return engine_lib.PricingEngine(book, inflation, shared.meta['column'],
+                                    triangle=shared['engine/triangle'], ldf=shared['engine/ldf'],
+                                    input_hash=shared.meta['input_hash'])
+
+
+def datasetFromShared(shared):
+    '''This function returns the shared dataset as a dataframe over the shared columns (no copy of numeric columns)'''
+    columns = shared.meta['dataset_columns']
+    if not columns:
+        raise ValueError("the dataset was not shared")
+    return pd.DataFrame({column: shared['dataset/' + column] for column in columns}, copy=False)
+
+
+def initWorker(manifest):
+    '''Process pool initializer: attaches to the shared block once per worker'''
+    global _worker
+    shared = SharedArrays.attach(manifest)
+    _worker = {'shared': shared, 'engine': engineFromShared(shared), 'dataset': None}
+
+
+def workerEngine():
+    '''This function returns the PricingEngine of the current worker process'''
+    if _worker is None:
+        raise RuntimeError("the worker was not initialized with initWorker")
+    return _worker['engine']
+
+
+def workerDataset():
+    '''This function returns the shared dataset of the current worker process'''
+    if _worker is None:
+        raise RuntimeError("the worker was not initialized with initWorker")
+    if _worker['dataset'] is None:
+        _worker['dataset'] = datasetFromShared(_worker['shared'])
+    return _worker['dataset']
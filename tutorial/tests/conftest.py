@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# the tutorial modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratemaking_engine as engine_lib
+
+
+@pytest.fixture(scope="session")
+def engine():
+    return engine_lib.PricingEngine.load()
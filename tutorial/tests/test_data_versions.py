@@ -0,0 +1,35 @@
+import os
+import shutil
+
+import ratemaking_engine as engine_lib
+from data_versions import DataVersionManager
+
+
+def test_rebuild_hashes_the_files_once(tmp_path, monkeypatch):
+    data_file = shutil.copy(engine_lib.DATA_FILE, tmp_path)
+    inflation_file = shutil.copy(engine_lib.INFLATION_FILE, tmp_path)
+    manager = DataVersionManager(data_file, inflation_file, interval=3600).start()
+    try:
+        first = manager.current()
+        assert first.signature == engine_lib.inputHash(data_file, inflation_file)
+        assert first.engine.input_hash == first.signature
+
+        with open(data_file, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+        with open(data_file, "wb") as f:
+            f.writelines(lines[:-1])         # drop the last record
+        os.utime(data_file, ns=(0, 1))
+
+        calls = []
+        original = engine_lib.inputHash
+        monkeypatch.setattr(engine_lib, "inputHash", lambda *paths: calls.append(paths) or original(*paths))
+        assert manager.check() is False      # wait for the files to be stable
+        assert manager.check() is True
+        assert len(calls) == 1
+        second = manager.current()
+        assert second.version == first.version + 1
+        assert second.signature != first.signature
+        assert second.engine.input_hash == second.signature
+        assert len(second.dataset) == len(first.dataset) - 1
+    finally:
+        manager.stop()
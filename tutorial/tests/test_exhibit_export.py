@@ -0,0 +1,15 @@
+import openpyxl
+
+import exhibit_export
+
+
+def test_cdf_columns_are_age_to_ultimate(engine, tmp_path):
+    path = tmp_path / "exhibits.xlsx"
+    exhibit_export.exportSingleWorkbook(engine, str(path), grcodes=[86])
+    sheet = openpyxl.load_workbook(path, read_only=True).worksheets[0]
+    rows = [[c for c in row if c is not None] for row in sheet.iter_rows(values_only=True)]
+    cdf = next(k for k, row in enumerate(rows) if row[:1] == ["CDF"])
+    assert rows[cdf - 1][1:4] == ["12-ult", "24-ult", "36-ult"]
+    selected = next(k for k, row in enumerate(rows) if row[:1] == ["Selected LDF"])
+    assert rows[selected - 1][1:3] == ["12-24", "24-36"]
+    assert rows[selected - 1][-1] == "120-ult"
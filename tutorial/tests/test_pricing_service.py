@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import pytest
+
+from pricing_service import PricingService
+
+
+async def _post(port, body):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("POST /indication HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                 .format(len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(payload)
+
+
+def _request(engine, bodies):
+    async def run():
+        service = PricingService(engine)
+        server = await service.start(port=0)
+        try:
+            port = server.sockets[0].getsockname()[1]
+            return [await _post(port, body) for body in bodies]
+        finally:
+            await service.close()
+    return asyncio.run(run())
+
+
+def test_valid_request(engine):
+    [(status, payload)] = _request(engine, [b'{"GRCODE": 86}'])
+    assert status == 200
+    assert payload['GRCODE'] == 86
+
+
+@pytest.mark.parametrize("body", [
+    b'{"GRCODE": Infinity}',
+    b'{"GRCODE": NaN}',
+    b'{"GRCODE": 1e400}',
+    b'{"GRCODE": 86, "assumptions": {"ldf_latest": Infinity}}',
+    b'{"GRCODE": 86, "assumptions": {"ldf_latest": 1e400}}',
+    b'{"GRCODE": 86, "assumptions": {"tail": 1e400}}',
+    b'{"GRCODE": 86, "assumptions": {"rate_changes": {"1990-01-01": 1e400}}}',
+])
+def test_non_finite_numbers_are_bad_requests(engine, body):
+    [(status, payload)] = _request(engine, [body])
+    assert status == 400
+    assert 'error' in payload
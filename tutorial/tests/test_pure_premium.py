@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import pure_premium
+
+
+@pytest.fixture(scope="module")
+def exposures(engine):
+    return pure_premium.impliedPayroll(engine, rate_per_100=2.0)
+
+
+def _purePremium(engine, exposures, **trends):
+    cells = pure_premium.purePremiumIndication(engine, exposures, grcodes=[86], pure_premium_assumptions=trends)
+    return cells['pure_premium'].to_numpy()
+
+
+def test_wage_growth_passed_to_severity_leaves_pure_premium_unchanged(engine, exposures):
+    flat = _purePremium(engine, exposures, wage_inflation=0.0, severity_trend=0.0, frequency_trend=0.0)
+    wages = _purePremium(engine, exposures, wage_inflation=0.05, severity_trend=0.05, frequency_trend=0.0)
+    np.testing.assert_allclose(wages, flat, rtol=1e-12)
+
+
+def test_wage_growth_is_counted_once(engine, exposures):
+    flat = _purePremium(engine, exposures, wage_inflation=0.0, severity_trend=0.0, frequency_trend=0.0)
+    # claims per worker and severity flat: more payroll for the same losses
+    wages = _purePremium(engine, exposures, wage_inflation=0.05, severity_trend=0.0, frequency_trend=0.0)
+    assert np.all(wages < flat)
+    assert np.all(wages > flat / 1.05**12)
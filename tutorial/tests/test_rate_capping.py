@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rate_capping
+
+
+def test_impact_exhibit_leaves_out_cells_without_a_change():
+    cells = pd.DataFrame({
+        'GRCODE': [1, 1, 1, 2],
+        'change': [0.10, -0.05, np.nan, 0.02],
+        'premium': [100.0, 300.0, 600.0, 50.0],
+    })
+    capped, groups = rate_capping.capCells(cells, 'change', 'premium', floor=-1.0, cap=1.0)
+    exhibit = rate_capping.impactExhibit(capped, groups).set_index('GRCODE')
+    assert exhibit.loc[1, 'premium'] == pytest.approx(400.0)
+    assert exhibit.loc[1, 'indicated_change'] == pytest.approx((100*0.10 - 300*0.05) / 400)
+    assert exhibit.loc[1, 'proposed_change'] == pytest.approx(exhibit.loc[1, 'indicated_change'])
+    assert exhibit.loc[1, 'cells'] == 3
+    assert exhibit.loc[2, 'indicated_change'] == pytest.approx(0.02)
+
+
+def test_capped_group_meets_its_target():
+    cells = pd.DataFrame({'GRCODE': [1, 1, 1], 'change': [0.40, 0.05, -0.02], 'premium': [100.0, 100.0, 100.0]})
+    capped, groups = rate_capping.capCells(cells, 'change', 'premium', floor=-0.15, cap=0.15)
+    assert groups['converged'].all()
+    assert capped['capped_change'].max() == pytest.approx(0.15)
+    np.testing.assert_allclose(groups['achieved'], groups['target'])
@@ -0,0 +1,30 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import ratemaking_engine as engine_lib
+
+
+def test_caches_are_bounded(engine):
+    for day in range(engine_lib.CACHE_SIZE + 10):
+        engine.trendFactors(datetime.date(1999, 1, 1) + datetime.timedelta(days=day))
+        engine.changeFactors({datetime.date(1990, 1, 1) + datetime.timedelta(days=day): 0.05})
+    assert len(engine._trends) == engine_lib.CACHE_SIZE
+    assert len(engine._levels) == engine_lib.CACHE_SIZE
+
+
+def test_cached_values_are_reused(engine):
+    assert engine.averageLDF(5) is engine.averageLDF(5)
+    loss, prem = engine.trendFactors(datetime.date(1999, 1, 1))
+    assert np.all(np.isfinite(loss)) and np.all(np.isfinite(prem))
+
+
+@pytest.mark.parametrize("assumptions", [
+    {'ldf_latest': float('inf')},
+    {'tail': float('nan')},
+    {'rate_changes': {'1990-01-01': float('inf')}},
+])
+def test_non_finite_assumptions_are_rejected(assumptions):
+    with pytest.raises(ValueError):
+        engine_lib.normalizeAssumptions(assumptions)
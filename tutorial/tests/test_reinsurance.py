@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import reinsurance
+
+
+def test_quota_share_net_indication(engine):
+    treaty = {'type': 'quota_share', 'cession': 0.3, 'commission': 0.3}
+    exhibit = reinsurance.treatyIndications(engine, treaty, grcodes=[86])
+    cessions = reinsurance.treatyCessions(engine, treaty, grcodes=[86])
+    loss_ratio = (cessions['losses'] / cessions['premium']).mean()
+    # by hand: 30% of the premium ceded at 30% commission, 30% of the losses recovered, default provisions
+    # (ULAE 5%, fixed 8%, variable 10%, profit 7%)
+    cost = 0.3 * (1 - 0.3) - 0.3 * loss_ratio
+    expected = (loss_ratio * 1.05 + cost + 0.08) / (1 - 0.10 - 0.07) - 1
+    row = exhibit.iloc[0]
+    assert row['reinsurance_cost_ratio'] == pytest.approx(cost)
+    assert row['net_rate_change'] == pytest.approx(expected)
+    assert row['net_rate_change'] == pytest.approx(0.030446, abs=1e-5)
+    assert row['gross_rate_change'] == pytest.approx(0.049853, abs=1e-5)
+
+
+def test_reinsurance_at_a_margin_raises_the_rate(engine):
+    treaty = {'type': 'xol', 'retention': 250, 'limit': 500, 'loading': 0.3,
+              'severity': {'dist': 'lognormal', 'mean': 40, 'cv': 4}}
+    exhibit = reinsurance.treatyIndications(engine, treaty, grcodes=[86], seed=1)
+    assert np.all(exhibit['reinsurance_cost_ratio'] > 0)
+    assert np.all(exhibit['net_rate_change'] > exhibit['gross_rate_change'])
@@ -0,0 +1,254 @@
+# Triangle diagnostics.
+# Standard checks on the development triangles before the selected LDFs are accepted, computed for every company
+# in one vectorized pass over the (company x accident year x development period) LDF tensor of computeLDFTensor:
+#   - Mack's test for calendar year effects
+#   - Mack's test for correlation between adjacent development factors
+#   - standardized residuals of the development factors by accident year, lag and diagonal, and leave-one-out
+#     (studentized) residuals for flagging outliers
+#   - paid-to-incurred ratio triangles
+# The results are summarised in an exception list ranked by severity (each statistic as a multiple of its check's
+# flagging threshold), so that only the flagged triangles need to be reviewed.
+
+import warnings
+from math import comb
+
+import numpy as np
+import pandas as pd
+
+import ratemaking_engine as engine_lib
+
+# 95% two sided normal quantiles for flagging the tests (Mack uses 0.67, a 50% range, for the correlation test,
+# which flags about half of the book)
+CY_QUANTILE = 1.96
+CORRELATION_QUANTILE = 1.96
+# two sided 99% quantiles of Student's t by degrees of freedom, for the studentized residuals (degrees of freedom
+# above 20 use the value for 20, which is slightly conservative)
+RESIDUAL_T_QUANTILES = np.array([np.nan, 63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169,
+                                 3.106, 3.055, 3.012, 2.977, 2.947, 2.921, 2.898, 2.878, 2.861, 2.845])
+# paid losses above incurred losses are not possible without data problems
+PAID_INCURRED_LIMIT = 1.0
+
+
+def _diagonalIndex(n_years, n_periods):
+    '''This function returns the diagonal (calendar period) of every (accident year, development period) cell'''
+    return np.arange(n_years)[:, None] + np.arange(n_periods)[None, :]
+
+
+def _sumByDiagonal(values, n_diagonals):
+    '''This function sums (company x accident year x period) values along the diagonals'''
+    diag = _diagonalIndex(values.shape[1], values.shape[2])
+    onehot = (diag[..., None] == np.arange(n_diagonals)).astype(float)
+    return np.einsum('caj,ajk->ck', values, onehot)
+
+
+def calendarYearTest(ldf):
+    '''This function performs Mack's test for calendar year effects on all LDF triangles at once
+       Factors of each development period are classed as large or small compared with the period's median
+       (factors equal to the median are dropped); each diagonal contributes Z = min(#small, #large).
+       Returns a dictionary of arrays of shape (company,)'''
+    valid = np.isfinite(ldf)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)     # all-NaN development periods
+        median = np.nanmedian(np.where(valid, ldf, np.nan), axis=1, keepdims=True)
+    small = valid & (ldf < median)
+    large = valid & (ldf > median)
+    n_diagonals = ldf.shape[1] + ldf.shape[2] - 1
+    S = _sumByDiagonal(small.astype(float), n_diagonals)
+    L = _sumByDiagonal(large.astype(float), n_diagonals)
+    Z = np.minimum(S, L).sum(axis=1)
+
+    # moments of Z_k for every possible n = S_k + L_k
+    n_max = ldf.shape[1] + 1
+    EZ = np.zeros(n_max)
+    VarZ = np.zeros(n_max)
+    for n in range(1, n_max):
+        m = (n - 1) // 2
+        c = comb(n - 1, m)
+        EZ[n] = n/2 - c * n / 2**n
+        VarZ[n] = n*(n-1)/4 - c * n*(n-1) / 2**n + EZ[n] - EZ[n]**2
+    n = (S + L).astype(int)
+    expected = EZ[n].sum(axis=1)
+    sd = np.sqrt(VarZ[n].sum(axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.abs(Z - expected) / sd
+    score[~np.isfinite(score)] = 0.0
+    return {'Z': Z, 'expected': expected, 'sd': sd, 'score': score, 'flag': score > CY_QUANTILE}
+
+
+def _ranks(values, mask):
+    '''This function ranks values along the accident year axis, using only the cells in mask'''
+    ranked = np.argsort(np.argsort(np.where(mask, values, np.inf), axis=1, kind='stable'), axis=1) + 1
+    return np.where(mask, ranked, 0)
+
+
+def adjacentCorrelationTest(ldf):
+    '''This function performs Mack's test for correlation between adjacent development factors on all LDF triangles at once
+       Spearman's rank correlation T_k is computed for every pair of adjacent development periods and the T_k are
+       averaged with weights n_k - 1. Returns a dictionary of arrays of shape (company,)'''
+    valid = np.isfinite(ldf)
+    n_companies, _, n_periods = ldf.shape
+    total = np.zeros(n_companies)
+    weights = np.zeros(n_companies)
+    T_pairs = np.full((n_companies, max(n_periods - 1, 0)), np.nan)
+    for k in range(1, n_periods):
+        mask = valid[:, :, k-1] & valid[:, :, k]
+        n = mask.sum(axis=1)
+        r1 = _ranks(ldf[:, :, k-1], mask)
+        r2 = _ranks(ldf[:, :, k], mask)
+        d2 = ((r1 - r2)**2).sum(axis=1)
+        usable = n >= 3
+        with np.errstate(divide='ignore', invalid='ignore'):
+            T_k = np.where(usable, 1 - 6*d2 / (n**3 - n), np.nan)
+        T_pairs[:, k-1] = T_k
+        total += np.where(usable, (n - 1) * T_k, 0.0)
+        weights += np.where(usable, n - 1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        T = total / weights
+        # Var(T_k) = 1/(n_k - 1), so Var(T) = 1/sum(n_k - 1)
+        sd = 1 / np.sqrt(weights)
+        score = np.abs(T) / sd
+    score[~np.isfinite(score)] = 0.0
+    return {'T': T, 'T_pairs': T_pairs, 'sd': sd, 'score': score, 'flag': score > CORRELATION_QUANTILE}
+
+
+def mackSigma(ldf, triangle):
+    '''This function estimates the parameters of Mack's model for every development period:
+       the volume-weighted average f and sigma^2 = sum C (F - f)^2 / (n - 1).
+       Returns f, sigma (company x 1 x development period), the weights C and the mask of usable cells'''
+    earlier = triangle[..., :-1]
+    valid = np.isfinite(ldf) & np.isfinite(earlier) & (earlier > 0)
+    C = np.where(valid, earlier, 0.0)
+    F = np.where(valid, ldf, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = (C*F).sum(axis=1, keepdims=True) / C.sum(axis=1, keepdims=True)
+        n = valid.sum(axis=1, keepdims=True)
+        sigma = np.sqrt((C*(F - f)**2).sum(axis=1, keepdims=True) / (n - 1))
+    return f, sigma, C, valid
+
+
+def standardizedResiduals(ldf, triangle):
+    '''This function computes the standardized residuals of the development factors against the volume-weighted averages
+       r = (F - f) * sqrt(C) / sigma (Mack's model, see mackSigma).
+       Returns an array of shape (company x accident year x development period)'''
+    f, sigma, C, valid = mackSigma(ldf, triangle)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residuals = (np.where(valid, ldf, 0.0) - f) * np.sqrt(C) / sigma
+    residuals[~valid | ~np.isfinite(residuals)] = np.nan
+    return residuals
+
+
+def studentizedResiduals(ldf, triangle):
+    '''This function computes the leave-one-out (externally studentized) residuals of the development factors
+       Every factor is compared with the volume-weighted average and sigma of the other factors of its period:
+       t = (F - f) * sqrt(C * sum C / (sum C - C)) / sigma_(-i), which follows Student's t with n - 2 degrees of freedom.
+       Unlike the standardized residuals (whose squares sum to n - 1 in every period) they are not bounded; a factor
+       that differs from otherwise identical factors gets an infinite residual.
+       Returns the residuals and the degrees of freedom, both of shape (company x accident year x development period)'''
+    f, sigma, C, valid = mackSigma(ldf, triangle)
+    D = np.where(valid, ldf, 0.0) - f
+    total = C.sum(axis=1, keepdims=True)
+    n = valid.sum(axis=1, keepdims=True)
+    SS = (C * np.where(valid, D, 0.0)**2).sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rest = total - C
+        SS_rest = SS - C*D**2 - C**2 * D**2 / rest
+        # the other factors are all equal (e.g. fully developed years): any deviation is an outlier (t is infinite)
+        SS_rest = np.where(SS_rest > 1e-12 * SS, SS_rest, 0.0)
+        sigma_rest = np.sqrt(np.maximum(SS_rest, 0.0) / (n - 2))
+        t = D * np.sqrt(C * total / rest) / sigma_rest
+    df = np.broadcast_to(n - 2, t.shape)
+    usable = valid & (df >= 1) & ~np.isnan(t)
+    return np.where(usable, t, np.nan), np.where(usable, df, 0)
+
+
+def residualLimits(df):
+    '''This function returns the flagging limit of studentized residuals with the given degrees of freedom'''
+    return RESIDUAL_T_QUANTILES[np.clip(df, 0, len(RESIDUAL_T_QUANTILES) - 1)]
+
+
+def residualsByDiagonal(residuals):
+    '''This function averages the standardized residuals along every diagonal (company x calendar period)'''
+    valid = np.isfinite(residuals)
+    n_diagonals = residuals.shape[1] + residuals.shape[2] - 1
+    total = _sumByDiagonal(np.where(valid, residuals, 0.0), n_diagonals)
+    count = _sumByDiagonal(valid.astype(float), n_diagonals)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return total / count
+
+
+def paidToIncurred(book):
+    '''This function computes the paid-to-incurred ratio triangles (company x accident year x lag)'''
+    paid = book.triangle("CumPaidLoss_D")
+    incurred = book.triangle("IncurLoss_D")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = paid / incurred
+    ratio[~np.isfinite(ratio)] = np.nan
+    return ratio
+
+
+def residualHeatmap(residuals, years, title=""):
+    '''This function draws the standardized residuals of one company (accident year x development period) as a heatmap'''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    n_periods = residuals.shape[1]
+    df = pd.DataFrame(residuals, index=years,
+                      columns=["{}-{}".format((i+1)*12, (i+2)*12) for i in range(n_periods)])
+    fig, ax = plt.subplots()
+    sns.heatmap(df, ax=ax, annot=True, fmt=".1f", center=0, cmap="RdBu_r", linewidths=0.36, linecolor="black")
+    ax.set_title(title)
+    return fig
+
+
+def runDiagnostics(book, column="CumPaidLoss_D"):
+    '''This function runs every diagnostic on every company of the book
+       Returns a dictionary with the test results and the ranked exception list'''
+    triangle = book.triangle(column)
+    ldf = engine_lib.computeLDFTensor(triangle)
+    results = {
+        'calendar_year': calendarYearTest(ldf),
+        'correlation': adjacentCorrelationTest(ldf),
+        'residuals': standardizedResiduals(ldf, triangle),
+        'paid_to_incurred': paidToIncurred(book),
+    }
+    results['studentized_residuals'], results['residual_df'] = studentizedResiduals(ldf, triangle)
+    results['residuals_by_diagonal'] = residualsByDiagonal(results['residuals'])
+    results['exceptions'] = exceptionList(book, results)
+    return results
+
+
+def exceptionList(book, results):
+    '''This function collects the flagged items of all companies into one dataframe, most severe first
+       score is the statistic of the check (a z-score, a studentized residual or a ratio) and severity the score as a
+       multiple of the check's flagging limit, which is comparable across checks (above 1 means flagged)'''
+    frames = []
+    for check, key, stat, limit in [("calendar year effect", 'calendar_year', 'Z', CY_QUANTILE),
+                                    ("adjacent LDF correlation", 'correlation', 'T', CORRELATION_QUANTILE)]:
+        test = results[key]
+        idx = np.flatnonzero(test['flag'])
+        frames.append(pd.DataFrame({
+            'GRCODE': book.grcodes[idx], 'check': check, 'AccidentYear': np.nan, 'period': None,
+            'value': test[stat][idx], 'score': test['score'][idx], 'severity': test['score'][idx] / limit,
+        }))
+
+    residuals = results['studentized_residuals']
+    limits = residualLimits(results['residual_df'])
+    with np.errstate(invalid='ignore'):
+        c, a, j = np.nonzero(np.abs(np.nan_to_num(residuals)) > limits)
+    frames.append(pd.DataFrame({
+        'GRCODE': book.grcodes[c], 'check': "LDF residual outlier", 'AccidentYear': book.years[a],
+        'period': ["{}-{}".format((k+1)*12, (k+2)*12) for k in j],
+        'value': residuals[c, a, j], 'score': np.abs(residuals[c, a, j]),
+        'severity': np.abs(residuals[c, a, j]) / limits[c, a, j],
+    }))
+
+    ratio = results['paid_to_incurred']
+    c, a, l = np.nonzero(np.nan_to_num(ratio) > PAID_INCURRED_LIMIT)
+    frames.append(pd.DataFrame({
+        'GRCODE': book.grcodes[c], 'check': "paid exceeds incurred", 'AccidentYear': book.years[a],
+        'period': [str((k+1)*12) for k in l],
+        'value': ratio[c, a, l], 'score': ratio[c, a, l], 'severity': ratio[c, a, l] / PAID_INCURRED_LIMIT,
+    }))
+
+    exceptions = pd.concat([f for f in frames if len(f)], ignore_index=True) if any(len(f) for f in frames) \
+        else pd.DataFrame(columns=['GRCODE', 'check', 'AccidentYear', 'period', 'value', 'score', 'severity'])
+    return exceptions.sort_values('severity', ascending=False, ignore_index=True)